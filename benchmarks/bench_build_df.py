@@ -0,0 +1,81 @@
+"""
+Benchmark of `build_df_for_analysis` against the previous per-year concat
+implementation on a synthetic wide table.
+
+Usage: python benchmarks/bench_build_df.py [n_muni] [n_years]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.nbutils_load_data import (
+    build_df_for_analysis,
+    build_df_from_arrays,
+    extract_wide_arrays,
+)
+from synthetic import make_synthetic_pv_params
+
+
+def build_df_for_analysis_loop(pv_params, years):
+    """the previous implementation, kept here as the reference"""
+    df = []
+    constant_df = pv_params[
+        ["pref", "muni", "demand", "land_avail", "taxable_income", "pv_out"]
+    ]
+    for year in years:
+        col_yearly_y = [f"PV_{t}_{year}" for t in ["R", "S", "M", "U", "A"]]
+        pv_cap_y = pv_params[col_yearly_y]
+        pv_cap_y = 100 * pv_cap_y / pv_cap_y.sum()
+        pv_cap_y.columns = ["PV_R", "PV_S", "PV_M", "PV_U", "PV_A"]
+
+        lv_spr_df = pv_params[[f"LV_{year}", f"SPR_{year}"]]
+        lv_spr_df.columns = ["LV", "SPR"]
+
+        df_temp = pd.concat([constant_df, lv_spr_df, pv_cap_y], axis=1)
+        df_temp.insert(0, "year", year)
+        df.append(df_temp)
+    return pd.concat(df).reset_index(drop=True)
+
+
+def timeit(func, *args, repeat=3, **kwargs):
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    n_muni = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    n_years = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    years = range(2000, 2000 + n_years)
+
+    # correctness on a small table first
+    pv_small = make_synthetic_pv_params(500, years, seed=1)
+    pd.testing.assert_frame_equal(
+        build_df_for_analysis(pv_small, years),
+        build_df_for_analysis_loop(pv_small, years),
+        check_exact=True,
+    )
+
+    pv_params = make_synthetic_pv_params(n_muni, years)
+    mask = np.random.default_rng(2).random(n_muni) > 0.05
+    print(f"{n_muni:,} municipalities x {n_years} years -> {n_muni * n_years:,} rows")
+
+    t_loop = timeit(build_df_for_analysis_loop, pv_params, years)
+    t_vec = timeit(build_df_for_analysis, pv_params, years)
+    arrays = extract_wide_arrays(pv_params, years)
+    t_mask = timeit(build_df_from_arrays, arrays, mask=mask)
+    t_loop_mask = timeit(build_df_for_analysis_loop, pv_params[mask], years)
+
+    print(f"per-year loop           : {t_loop:8.3f} s")
+    print(f"vectorized              : {t_vec:8.3f} s  ({t_loop / t_vec:.1f}x)")
+    print(f"per-year loop, filtered : {t_loop_mask:8.3f} s")
+    print(f"cached arrays + mask    : {t_mask:8.3f} s  ({t_loop_mask / t_mask:.1f}x)")
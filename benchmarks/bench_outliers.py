@@ -0,0 +1,84 @@
+"""
+Benchmark of the batched outlier tagging (`get_pred_n_outliers_batch`) against the
+previous per-year calls that signed the flags with a row-wise `apply`.
+
+Usage: python benchmarks/bench_outliers.py [n_muni] [n_years]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+from sklearn.linear_model import LinearRegression
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from synthetic import make_synthetic_pv_params
+from utils.nbutils_load_data import build_df_for_analysis
+from utils.nbutils_regression import get_pred_n_outliers_batch
+
+
+def get_pred_n_outliers_z_score_apply(
+    df, vars_dv, vars_iv, model, year, threshold_multiplier
+):
+    """the previous implementation, kept here as the reference"""
+    df_year = df[df["year"] == year].reset_index(drop=True)
+    df_year["y_pred"] = model.predict(df_year[vars_iv])
+    df_year["residuals"] = df_year[vars_dv] - df_year["y_pred"]
+    mean_residual = df_year["residuals"].mean()
+    std_residual = df_year["residuals"].std()
+    df_year["z_score"] = (df_year["residuals"] - mean_residual) / std_residual
+    df_year["outliers"] = np.where(
+        np.abs(df_year["z_score"]) > threshold_multiplier, 1, 0
+    )
+    df_year = df_year.rename(columns={"y_pred": f"{vars_dv}_pred"})
+    df_year["outliers"] = df_year.apply(
+        lambda row: row["outliers"] * np.sign(row["residuals"]), axis=1
+    )
+    return df_year
+
+
+if __name__ == "__main__":
+    n_muni = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    n_years = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    years = list(range(2014, 2014 + n_years))
+    vars_iv = ["demand", "land_avail", "taxable_income", "LV", "SPR", "pv_out"]
+    pv_types = ["PV_R", "PV_S"]
+
+    df = build_df_for_analysis(make_synthetic_pv_params(n_muni, years), years)
+    print(f"{len(df):,} rows x {len(pv_types)} PV types")
+
+    # a cheap model so that the timings are dominated by the tagging
+    models = {
+        var_dv: {
+            year: LinearRegression().fit(df_y[vars_iv], df_y[var_dv])
+            for year, df_y in df.groupby("year")
+        }
+        for var_dv in pv_types
+    }
+
+    start = time.perf_counter()
+    df_outliers = []
+    for var_dv in pv_types:
+        for year in years:
+            df_temp = get_pred_n_outliers_z_score_apply(
+                df, var_dv, vars_iv, models[var_dv][year], year, 3
+            )
+            df_outliers.append(df_temp["outliers"].to_numpy())
+    t_apply = time.perf_counter() - start
+
+    start = time.perf_counter()
+    df_batch = get_pred_n_outliers_batch(
+        df, pv_types, vars_iv, models, threshold_multiplier=3
+    )
+    t_batch = time.perf_counter() - start
+
+    flags_apply = np.concatenate(df_outliers)
+    flags_batch = np.concatenate([df_batch[var_dv].to_numpy() for var_dv in pv_types])
+    assert (flags_apply == flags_batch).all()
+
+    print(f"per-year calls with row-wise apply : {t_apply:8.3f} s")
+    print(
+        f"batched                            : {t_batch:8.3f} s  ({t_apply / t_batch:.1f}x)"
+    )
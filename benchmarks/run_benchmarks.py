@@ -0,0 +1,379 @@
+"""
+Benchmark suite of the hot paths of the notebooks on synthetic data:
+
+    load     `load_and_process_data` on a synthetic `pv_muni_params.csv`
+    train    `regression_analysis_yearly` with a `RandomForestRegressor` (notebook 02)
+    outlier  `get_pred_n_outliers_z_score` for every year (notebook 02)
+    shap     the RFR, TreeSHAP values and plots of `plot_feature_importance_base`
+    cluster  KMeans elbow sweep, KMeans clustering and RFC of the SHAP scores (03a)
+
+Each stage is timed (wall and CPU, best of `--repeat`) and run once more under
+tracemalloc for its peak memory. The results are written to JSON together with the
+commit, so that two runs can be compared with `--compare`.
+
+Usage:
+    python benchmarks/run_benchmarks.py --preset smoke
+    python benchmarks/run_benchmarks.py --preset large
+    python benchmarks/run_benchmarks.py --sizes 2000x10 8000x10 --stages load train
+    python benchmarks/run_benchmarks.py --compare old.json new.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import matplotlib
+
+matplotlib.use("Agg")
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.cluster import KMeans
+from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
+from sklearn.model_selection import train_test_split
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from synthetic import write_synthetic_csv
+from utils.nbutils_load_data import load_and_process_data
+from utils.nbutils_regression import (
+    get_pred_n_outliers_z_score,
+    regression_analysis_yearly,
+)
+from utils.nbutils_shap import (
+    compute_shap_values,
+    plot_shap_values,
+    train_shap_model,
+    vars_iv_shap,
+)
+
+vars_iv = ["demand", "land_avail", "taxable_income", "LV", "SPR", "pv_out"]
+var_dv = "PV_R"
+
+presets = {
+    # a few seconds, to check that every stage still runs
+    "smoke": {
+        "sizes": [(300, 5)],
+        "n_estimators": 10,
+        "shap_rows": 300,
+        "k_max": 6,
+        "repeat": 1,
+    },
+    # scaling curves over the number of municipalities and of years
+    "large": {
+        "sizes": [(1_000, 10), (5_000, 10), (20_000, 10), (20_000, 30)],
+        "n_estimators": 100,
+        "shap_rows": 2_000,
+        "k_max": 14,
+        "repeat": 3,
+    },
+}
+stage_names = ["load", "train", "outlier", "shap", "cluster"]
+
+
+# ============================================================================ #
+# Stages
+# ============================================================================ #
+# each stage reads its inputs from and writes its outputs to the shared `ctx` dict,
+# so that it can be run repeatedly with the same inputs.
+def stage_load(ctx, config):
+    ctx["pv_params"], ctx["df"] = load_and_process_data(ctx["folder"])
+
+
+def stage_train(ctx, config):
+    model = RandomForestRegressor(
+        n_estimators=config["n_estimators"],
+        random_state=42,
+        n_jobs=config["n_jobs"],
+    )
+    _, ctx["models"], _ = regression_analysis_yearly(ctx["df"], vars_iv, var_dv, model)
+
+
+def stage_outlier(ctx, config):
+    ctx["df_outliers"] = [
+        get_pred_n_outliers_z_score(ctx["df"], var_dv, vars_iv, model, year)
+        for year, model in ctx["models"].items()
+    ]
+
+
+def stage_shap(ctx, config):
+    # the steps of `plot_feature_importance_base`, keeping the SHAP values for the
+    # clustering. TreeSHAP is the slowest step, so the sample is capped.
+    df = ctx["df"]
+    df_temp = df[df["year"] == df["year"].max()].head(config["shap_rows"])
+    X = df_temp[vars_iv_shap]
+    y = df_temp[var_dv]
+    model = train_shap_model(X, y, random_state=42)
+    shap_values, expected_value = compute_shap_values(model, X)
+    with contextlib.redirect_stdout(io.StringIO()):
+        plot_shap_values(shap_values, X, vars_iv_shap, expected_value, y)
+    plt.close("all")
+    ctx["X_shap"] = X
+    ctx["shap_values"] = shap_values
+    ctx["expected_value"] = expected_value
+
+
+def stage_cluster(ctx, config):
+    X = ctx["X_shap"]
+    scores = pd.DataFrame(ctx["shap_values"], columns=[f"{c}_score" for c in vars_iv])
+
+    # elbow curve
+    k_values = range(1, min(config["k_max"], len(scores)) + 1)
+    inertia_values = [
+        KMeans(n_clusters=k, random_state=42).fit(scores).inertia_ for k in k_values
+    ]
+
+    # clustering with the chosen k, ordered by the mean SHAP value of the cluster
+    kmeans = KMeans(n_clusters=min(8, len(scores)), random_state=42)
+    labels = pd.Series(kmeans.fit_predict(scores))
+    shap_sum = scores.sum(axis=1) + ctx["expected_value"]
+    order = shap_sum.groupby(labels).mean().sort_values(ascending=False).index
+    labels = labels.map(dict(zip(order, range(len(order)))))
+
+    # random forest classifier of the cluster
+    X_train, X_test, y_train, y_test = train_test_split(
+        X, labels.to_numpy(), test_size=0.2, random_state=42
+    )
+    rf_clf = RandomForestClassifier(
+        n_estimators=config["n_estimators"],
+        random_state=42,
+        n_jobs=config["n_jobs"],
+    )
+    rf_clf.fit(X_train, y_train)
+    ctx["inertia_values"] = inertia_values
+    ctx["cluster_pred"] = rf_clf.predict(X_test)
+
+
+stages = {
+    "load": stage_load,
+    "train": stage_train,
+    "outlier": stage_outlier,
+    "shap": stage_shap,
+    "cluster": stage_cluster,
+}
+
+
+# ============================================================================ #
+# Measurement
+# ============================================================================ #
+def measure(func, ctx, config, repeat=1):
+    """
+    best wall and CPU time over `repeat` runs, then the peak memory traced by
+    tracemalloc in one more run. Memory allocated by worker processes is not traced.
+    """
+    wall = cpu = np.inf
+    for _ in range(repeat):
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        func(ctx, config)
+        wall = min(wall, time.perf_counter() - start_wall)
+        cpu = min(cpu, time.process_time() - start_cpu)
+
+    tracemalloc.start()
+    try:
+        func(ctx, config)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return wall, cpu, peak
+
+
+def run_size(n_muni, n_years, config, selected):
+    """
+    runs the stages in order on one synthetic table. Stages that are not selected
+    still run once, untimed, when a selected stage needs their output.
+    """
+    years = list(range(2023 - n_years + 1, 2024))
+    last = max(stage_names.index(stage) for stage in selected)
+    records = []
+    with tempfile.TemporaryDirectory() as folder:
+        write_synthetic_csv(folder, n_muni, years, seed=config["seed"])
+        ctx = {"folder": folder}
+        for stage in stage_names[: last + 1]:
+            if stage not in selected:
+                stages[stage](ctx, config)
+                continue
+            wall, cpu, peak = measure(stages[stage], ctx, config, config["repeat"])
+            records.append(
+                {
+                    "stage": stage,
+                    "n_muni": n_muni,
+                    "n_years": n_years,
+                    "rows": n_muni * n_years,
+                    "wall_s": round(wall, 6),
+                    "cpu_s": round(cpu, 6),
+                    "peak_mb": round(peak / 2**20, 3),
+                }
+            )
+            print(
+                f"{stage:8s} {n_muni:>8,} x {n_years:>3} "
+                f"wall {wall:9.3f} s  cpu {cpu:9.3f} s  peak {peak / 2**20:9.1f} MB",
+                flush=True,
+            )
+    return records
+
+
+def git_commit():
+    """
+    the current commit and whether the working tree has uncommitted changes.
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def environment():
+    import shap
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "sklearn": sklearn.__version__,
+        "shap": shap.__version__,
+    }
+
+
+# ============================================================================ #
+# Comparison
+# ============================================================================ #
+def compare(old_fn, new_fn, tolerance=1.2):
+    """
+    prints the ratios new/old of the wall time and peak memory of the stages measured
+    in both files, and returns the number of ratios above `tolerance`.
+    """
+    with open(old_fn) as f:
+        old = json.load(f)
+    with open(new_fn) as f:
+        new = json.load(f)
+
+    keys = ["stage", "n_muni", "n_years"]
+    df = pd.merge(
+        pd.DataFrame(old["results"]),
+        pd.DataFrame(new["results"]),
+        on=keys,
+        suffixes=("_old", "_new"),
+    )
+    df["wall_ratio"] = df["wall_s_new"] / df["wall_s_old"]
+    df["peak_ratio"] = df["peak_mb_new"] / df["peak_mb_old"]
+    df["regression"] = (df["wall_ratio"] > tolerance) | (df["peak_ratio"] > tolerance)
+
+    print(f"old: {old['commit']}  new: {new['commit']}")
+    cols = keys + ["wall_s_old", "wall_s_new", "wall_ratio", "peak_ratio", "regression"]
+    print(df[cols].to_string(index=False, float_format="{:.3f}".format))
+    return int(df["regression"].sum())
+
+
+def parse_size(text):
+    n_muni, n_years = text.lower().split("x")
+    return int(n_muni), int(n_years)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--preset", choices=list(presets), default="smoke")
+    parser.add_argument(
+        "--sizes",
+        nargs="+",
+        type=parse_size,
+        help="sizes as <municipalities>x<years>, overriding the preset",
+    )
+    parser.add_argument("--stages", nargs="+", choices=stage_names, default=stage_names)
+    parser.add_argument("--repeat", type=int, help="overrides the preset")
+    parser.add_argument("--n-estimators", type=int, help="overrides the preset")
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--output",
+        help="results file, benchmarks/results/<commit>-<preset>.json by default",
+    )
+    parser.add_argument(
+        "--compare",
+        nargs=2,
+        metavar=("OLD", "NEW"),
+        help="compare two results files instead of running",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1.2,
+        help="ratio above which --compare reports a regression",
+    )
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        n_regressions = compare(*args.compare, tolerance=args.tolerance)
+        return 1 if n_regressions else 0
+
+    config = dict(presets[args.preset])
+    for name in ["sizes", "repeat", "n_estimators"]:
+        if getattr(args, name) is not None:
+            config[name] = getattr(args, name)
+    config["n_jobs"] = args.n_jobs
+    config["seed"] = args.seed
+
+    records = []
+    for n_muni, n_years in config["sizes"]:
+        records += run_size(n_muni, n_years, config, args.stages)
+
+    commit, dirty = git_commit()
+    output = args.output
+    if output is None:
+        output = os.path.join(
+            ROOT,
+            "benchmarks",
+            "results",
+            f"{(commit or 'nogit')[:10]}-{args.preset}.json",
+        )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(
+            {
+                "commit": commit,
+                "dirty": dirty,
+                "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                "preset": args.preset,
+                "config": {**config, "stages": args.stages},
+                "environment": environment(),
+                "results": records,
+            },
+            f,
+            indent=2,
+        )
+    print(f"results written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""
+Synthetic tables with the schema of `data/pv_muni_params.csv`, at any number of
+municipalities and years, for the benchmarks.
+
+The values follow the rough scale of the real data (lognormal sizes, cumulative PV
+capacities that grow every year) so that the models and the clustering do comparable
+work, but they carry no meaning.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.nbutils_load_data import process_pv_params
+
+pv_raw_types = ["PV_R", "PV_S", "PV_M", "PV_U"]
+
+
+def make_raw_pv_params(n_muni, years, seed=0):
+    """
+    the raw table as read from `pv_muni_params.csv`, before `process_pv_params`.
+    """
+    rng = np.random.default_rng(seed)
+    years = list(years)
+    n_years = len(years)
+
+    land_total = rng.lognormal(9, 1, n_muni)
+    land_habitable = land_total * rng.uniform(0.1, 0.9, n_muni)
+    data = {
+        "pref": np.char.add("pref_", rng.integers(1, 48, n_muni).astype(str)),
+        "muni": np.char.add("muni_", np.arange(n_muni).astype(str)),
+        "demand": rng.lognormal(12, 1.5, n_muni),
+        "land_total": land_total,
+        "land_habitable": land_habitable,
+        "land_buildings": land_habitable * rng.uniform(0.05, 0.4, n_muni),
+        "land_agri": land_habitable * rng.uniform(0.05, 0.5, n_muni),
+        "taxable_income": rng.lognormal(18, 1.5, n_muni),
+    }
+
+    # land value grows slowly from a base value
+    lv_base = rng.lognormal(10, 1, n_muni)
+    data["LV"] = lv_base
+    lv_growth = np.cumprod(rng.normal(1.01, 0.01, (n_muni, n_years)), axis=1)
+    for i, year in enumerate(years):
+        data[f"LV_{year}"] = lv_base * lv_growth[:, i]
+
+    # installed capacities are cumulative, so they never decrease
+    for pv_type in pv_raw_types:
+        pv_base = rng.lognormal(7, 2, n_muni)
+        pv_growth = np.cumprod(rng.lognormal(0.08, 0.05, (n_muni, n_years)), axis=1)
+        for i, year in enumerate(years):
+            data[f"{pv_type}_{year}"] = pv_base * pv_growth[:, i]
+
+    data["pv_out"] = rng.normal(1250, 60, n_muni)
+    data["epco"] = np.char.add("epco_", rng.integers(0, 10, n_muni).astype(str))
+
+    spr = np.cumsum(rng.uniform(0, 0.02, (n_muni, n_years)), axis=1)
+    for i, year in enumerate(years):
+        data[f"SPR_{year}"] = spr[:, i]
+
+    return pd.DataFrame(data)
+
+
+def make_synthetic_pv_params(n_muni, years, seed=0):
+    """
+    the table as returned by `load_and_process_data`, with `PV_A_{year}` and
+    `land_avail`.
+    """
+    return process_pv_params(make_raw_pv_params(n_muni, years, seed))
+
+
+def write_synthetic_csv(folder, n_muni, years, seed=0):
+    """
+    writes a synthetic `pv_muni_params.csv` into `folder` and returns its path.
+    """
+    os.makedirs(folder, exist_ok=True)
+    fileloc = os.path.join(folder, "pv_muni_params.csv")
+    make_raw_pv_params(n_muni, years, seed).to_csv(fileloc, index=False)
+    return fileloc
@@ -10,6 +10,8 @@ during the analysis process.
 import os
 import shutil
 
+from utils.pipeline import pipeline_artifacts
+
 def delete_paths(paths):
     for path in paths:
         if os.path.exists(path):
@@ -30,16 +32,7 @@ def delete_paths(paths):
 
 
 if __name__ == "__main__":
-    paths_to_delete = [
-        "fig",
-        "data/pv_growth_outlier.csv",
-        "data/model_RFC_PV_R_2023.joblib",
-        "data/model_RFR_PV_R.joblib",
-        "data/shap_values_summary_PV_R.csv",
-        "data/model_RFC_PV_S_2023.joblib",
-        "data/model_RFR_PV_S.joblib",
-        "data/shap_values_summary_PV_S.csv"
-    ]
+    paths_to_delete = ["fig"] + pipeline_artifacts("data")
 
     print("Deleting the following paths:")
     for path in paths_to_delete:
@@ -0,0 +1,38 @@
+"""
+This script runs the analysis of notebooks 02, 03a/03b and 04 without Jupyter.
+Only the stages whose inputs, parameters or code changed since their last run are
+executed; the PV_R and PV_S SHAP stages run in parallel.
+
+Usage:
+    python run-pipeline.py                    # run every stale stage
+    python run-pipeline.py --dry-run          # list the stale stages
+    python run-pipeline.py shap_PV_R --force  # re-run a stage and its dependencies
+"""
+
+import argparse
+import time
+
+from utils.pipeline import get_stages, run_pipeline
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the analysis pipeline.")
+    parser.add_argument(
+        "targets", nargs="*", help=f"stages to bring up to date {list(get_stages())}"
+    )
+    parser.add_argument("--folder", default="data", help="data folder")
+    parser.add_argument("--force", action="store_true", help="re-run fresh stages")
+    parser.add_argument("--dry-run", action="store_true", help="only list the stages")
+    parser.add_argument(
+        "--workers", type=int, default=2, help="number of stages run in parallel"
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    run_pipeline(
+        args.folder,
+        targets=args.targets or None,
+        force=args.force,
+        max_workers=args.workers,
+        dry_run=args.dry_run,
+    )
+    print(f"Pipeline finished in {time.perf_counter() - start:.1f} s")
@@ -1,32 +1,102 @@
+"""
+Japanese administrative names and codes.
+
+The prefecture tables below are constants. The municipality tables come from
+`data/japanadmincode.csv` and are parsed on first use, once per process: use
+`admincode_table`, `muni_en_map` and the vectorized lookups at the end of the module.
+The module-level names `japanadmincode`, `japanadmincode_all`,
+`japanadmin_muni_jp_to_en` and `japanadmin_muni_all_jp_to_en` are still available and
+are evaluated lazily as well.
+"""
+
+import functools
 import os
+
+import numpy as np
 import pandas as pd
 
-japanadmincode_fn = os.path.join("data", "japanadmincode.csv")
-if os.path.exists(japanadmincode_fn):
-    japanadmincode = pd.read_csv(japanadmincode_fn)
-    japanadmincode = (
-        japanadmincode[japanadmincode.cat.isin(["1", "2", "3"])]
-        .rename(columns={"prefname": "pref", "muniname": "muni"})
-        .set_index(["pref", "muni"])
-    )
-    japanadmincode = japanadmincode.reset_index()
-    japanadmin_muni_jp_to_en = japanadmincode.set_index("muni")["en"].to_dict()
-
-else:
-    japanadmincode = None
-
-if os.path.exists(japanadmincode_fn):
-    japanadmincode_all = pd.read_csv(japanadmincode_fn)
-    japanadmincode_all = (
-        japanadmincode_all[japanadmincode_all.cat.isin(["0", "1", "2", "3"])]
-        .rename(columns={"prefname": "pref", "muniname": "muni"})
-        .set_index(["pref", "muni"])
-    )
-    japanadmincode_all = japanadmincode_all.reset_index()
-    japanadmin_muni_all_jp_to_en = japanadmincode_all.set_index("muni")["en"].to_dict()
+# resolved from the package, not from the working directory
+japanadmincode_fn = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "data",
+    "japanadmincode.csv",
+)
+
+# `cat` of the rows of each table: 0 prefectures, 1-3 municipalities
+admincode_cats = {"muni": ["1", "2", "3"], "all": ["0", "1", "2", "3"]}
+
+
+@functools.lru_cache(maxsize=None)
+def _read_admincode(fn):
+    if not os.path.exists(fn):
+        raise FileNotFoundError(f"japanese administrative codes not found: {fn}")
+    return pd.read_csv(fn).rename(columns={"prefname": "pref", "muniname": "muni"})
+
+
+@functools.lru_cache(maxsize=None)
+def admincode_table(level="all", fn=japanadmincode_fn):
+    """
+    rows of `japanadmincode.csv` with `pref`/`muni` columns: the municipalities
+    (`level="muni"`) or the municipalities and prefectures (`level="all"`). The table
+    is shared between callers and must not be modified.
+    """
+    df = _read_admincode(fn)
+    df = df[df["cat"].isin(admincode_cats[level])]
+    cols = ["pref", "muni"] + [c for c in df.columns if c not in ["pref", "muni"]]
+    return df[cols].reset_index(drop=True)
+
+
+@functools.lru_cache(maxsize=None)
+def muni_en_map(level="all", fn=japanadmincode_fn):
+    """
+    municipality name -> english name, for `Series.map`. Names shared by several
+    municipalities map to the last one in the file.
+    """
+    return admincode_table(level, fn).set_index("muni")["en"].to_dict()
+
+
+@functools.lru_cache(maxsize=None)
+def _admincode_keys(fn):
+    df = admincode_table("all", fn)
+    return pd.MultiIndex.from_frame(df[["pref", "muni"]]), df
+
+
+def _lookup(pref, muni, column, fn):
+    keys, df = _admincode_keys(fn)
+    pos = keys.get_indexer(pd.MultiIndex.from_arrays([pref, muni]))
+    values = df[column].to_numpy()[pos]
+    return pos, values
+
+
+def muni_en(pref, muni, fn=japanadmincode_fn):
+    """
+    english names of the (pref, muni) pairs given as two arrays, NaN for unknown keys.
+    Unlike `muni_en_map`, municipalities with the same name are told apart.
+    """
+    pos, values = _lookup(pref, muni, "en", fn)
+    return np.where(pos == -1, np.nan, values)
+
+
+def muni_code(pref, muni, fn=japanadmincode_fn):
+    """
+    municodes of the (pref, muni) pairs given as two arrays, -1 for unknown keys.
+    """
+    pos, values = _lookup(pref, muni, "municode", fn)
+    return np.where(pos == -1, -1, values)
+
+
+def __getattr__(name):
+    # the tables that used to be built at import time
+    lazy = {
+        "japanadmincode": lambda: admincode_table("muni"),
+        "japanadmincode_all": lambda: admincode_table("all"),
+        "japanadmin_muni_jp_to_en": lambda: muni_en_map("muni"),
+        "japanadmin_muni_all_jp_to_en": lambda: muni_en_map("all"),
+    }
+    if name in lazy:
+        return lazy[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-else:
-    japanadmincode_all = None
 
 tokyo_wards = [
     "千代田区",
@@ -165,3 +235,28 @@ prefecture_dict_en_to_no = {
     for pref in prefecture_dict_en_to_jp.keys()
 }
 prefecture_dict_no_to_en = {v: k for k, v in prefecture_dict_en_to_no.items()}
+
+
+def pref_jp_to_en(pref):
+    """
+    english names of the prefectures of the series `pref`.
+    """
+    return pd.Series(pref).map(prefecture_dict_jp_to_en)
+
+
+def pref_to_no(pref):
+    """
+    numbers of the prefectures of the series `pref`, in japanese or english.
+    """
+    pref = pd.Series(pref)
+    return pref.map(prefecture_dict_r).fillna(pref.map(prefecture_dict_en_r))
+
+
+def pref_from_no(pref_no, lang="en"):
+    """
+    names of the prefecture numbers of the series `pref_no`, in english (`lang="en"`)
+    or japanese.
+    """
+    return pd.Series(pref_no).map(
+        prefecture_dict_en if lang == "en" else prefecture_dict
+    )
@@ -0,0 +1,92 @@
+import hashlib
+import glob
+import os
+
+# source files whose content is part of every cache key. Editing the processing code
+# invalidates the cached results the same way as editing the data.
+code_files = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "nbutils_load_data.py"),
+    os.path.abspath(__file__),
+]
+categorical_cols = ["pref", "muni"]
+
+
+def file_hash(*paths, chunk_size=1 << 20):
+    """
+    sha256 of the content of the given files, in order.
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def cache_key(*source_paths):
+    """
+    key of the processed data derived from `source_paths` with the current code.
+    """
+    return file_hash(*source_paths, *code_files)[:16]
+
+
+def _cache_fn(cache_dir, name, key):
+    return os.path.join(cache_dir, f"{name}-{key}.feather")
+
+
+def as_categorical(df):
+    """
+    `df` with the `pref`/`muni` columns it has as categoricals.
+    """
+    return df.astype({c: "category" for c in categorical_cols if c in df.columns})
+
+
+def write_cached_frame(cache_dir, name, key, df):
+    """
+    stores `df` as an uncompressed feather file so that it can be memory-mapped on read.
+    The `pref`/`muni` columns are stored as categoricals. Files of the same name with
+    another key are stale and are removed.
+    """
+    import pyarrow.feather as feather
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for fn in glob.glob(os.path.join(cache_dir, f"{name}-*.feather")):
+        if fn != _cache_fn(cache_dir, name, key):
+            os.remove(fn)
+
+    df = as_categorical(df)
+    fn = _cache_fn(cache_dir, name, key)
+    # write to a temporary file first so an interrupted write is never read back
+    feather.write_feather(df, fn + ".tmp", compression="uncompressed")
+    os.replace(fn + ".tmp", fn)
+
+
+def read_cached_frame(cache_dir, name, key, categorical=False):
+    """
+    returns the cached frame or None on a cache miss. The categorical key columns are
+    converted back to strings unless `categorical` is set.
+    """
+    import pyarrow.feather as feather
+
+    fn = _cache_fn(cache_dir, name, key)
+    if not os.path.exists(fn):
+        return None
+
+    df = feather.read_table(fn, memory_map=True).to_pandas()
+    if not categorical:
+        for col in categorical_cols:
+            if col in df.columns:
+                df[col] = df[col].astype(object)
+    return df
+
+
+def read_latest_cached_frame(cache_dir, name, categorical=False):
+    """
+    the most recently written frame of `name` regardless of its key, or None.
+    """
+    fns = glob.glob(os.path.join(cache_dir, f"{name}-*.feather"))
+    if not fns:
+        return None
+    fn = max(fns, key=os.path.getmtime)
+    key = os.path.basename(fn)[len(name) + 1 : -len(".feather")]
+    return read_cached_frame(cache_dir, name, key, categorical)
@@ -1,6 +1,8 @@
 import pandas as pd
 import numpy as np
-import re
+
+from utils.nbutils_muni_index import get_muni_key_index
+from utils.nbutils_profile import profiled
 
 
 def format_mean_std(df, column_name, mean_sno=1, std_sno=2, spacer=" ", std_per=False):
@@ -36,34 +38,113 @@ def apply_scale(df_orig, scale_dict):
 
 
 def get_pref_muni_isin(df, index_list):
-    return df[df[["pref", "muni"]].apply(tuple, axis=1).isin(index_list)]
+    return df[get_muni_key_index().isin(df, index_list)]
 
 
 def calc_n_show_mean_std(df, scale_param, std_per=False):
-    stats = dict()
-    for key in scale_param.index:
-        stats[key] = format_mean_std(
-            df,
-            key,
-            mean_sno=scale_param.loc[key, "mean_sno"],
-            std_sno=scale_param.loc[key, "std_sno"],
-            spacer=" ",
-            std_per=std_per,
+    stats = compute_cluster_stats(df, np.zeros(len(df), dtype=int), scale_param.index)
+    stats = render_mean_std(
+        stats,
+        scale_param["mean_sno"].to_dict(),
+        scale_param["std_sno"].to_dict(),
+        spacer=" ",
+        std_per=std_per,
+    )
+    return stats.iloc[0].to_dict()
+
+
+def cluster_rows(df, cluster_index):
+    """
+    positions of the rows of `df` in every cluster of `cluster_index` (cluster number
+    -> (pref, muni) keys) and their cluster number. A row may belong to several
+    clusters.
+    """
+    key_index = get_muni_key_index()
+    df_codes = key_index.codes(df)
+    rows, labels = [], []
+    for cluster_no, cluster_indx in cluster_index.items():
+        pos = np.flatnonzero(np.isin(df_codes, key_index.codes(cluster_indx)))
+        rows.append(pos)
+        labels.append(np.full(len(pos), cluster_no, dtype=object))
+    return np.concatenate(rows), np.concatenate(labels)
+
+
+@profiled(rows="df")
+def compute_cluster_stats(
+    df, clusters, columns, scale_dict=None, stats=("mean", "std"), quantiles=None
+):
+    """
+    statistics of `columns` of every cluster in one groupby aggregation.
+    `clusters` is either the cluster number of each row of `df` (e.g. the
+    `kmeans_cluster` column) or a dict of cluster number -> (pref, muni) keys as in
+    `get_cluster_actual_stats`. The columns are divided by `scale_dict` first.
+    `stats` are groupby aggregations ("mean", "std" with ddof=1, "median", "count", ...)
+    and `quantiles` adds the columns `q{100 * q:g}`.
+    Returns a dataframe indexed by cluster with (column, statistic) columns.
+    """
+    columns = list(columns)
+    values = df[columns]
+    if scale_dict is not None:
+        scale = pd.Series({c: scale_dict.get(c, 1) for c in columns}, dtype=float)
+        values = values.div(scale, axis=1)
+
+    if isinstance(clusters, dict):
+        rows, labels = cluster_rows(df, clusters)
+        order = list(clusters)
+        values = values.iloc[rows]
+    else:
+        labels = np.asarray(clusters)
+        order = None
+    grouped = values.groupby(labels, sort=True)
+
+    result = grouped.agg(list(stats))
+    for q in quantiles or []:
+        df_q = grouped.quantile(q)
+        df_q.columns = pd.MultiIndex.from_product([df_q.columns, [f"q{100 * q:g}"]])
+        result = pd.concat([result, df_q], axis=1)
+    result = result[
+        pd.MultiIndex.from_tuples(
+            [(c, stat) for c in columns for stat in result[c].columns]
         )
-    return stats
+    ]
+    if order is not None:
+        result = result.reindex(order)
+    return result
 
 
+def render_mean_std(stats, mean_sno, std_sno, spacer=" ", std_per=False):
+    """
+    formats the `mean` and `std` of `compute_cluster_stats` as `format_mean_std` does,
+    column by column. `mean_sno` and `std_sno` map each column to its decimals.
+    """
+    rendered = dict()
+    for col in stats.columns.get_level_values(0).unique():
+        mean_digits, std_digits = int(mean_sno[col]), int(std_sno[col])
+        mean_value = np.round(stats[(col, "mean")].to_numpy(dtype=float), mean_digits)
+        std_dev = np.round(stats[(col, "std")].to_numpy(dtype=float), std_digits)
+
+        mean_str = np.char.mod(f"%.{mean_digits}f", mean_value)
+        if std_per:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                std_str = np.char.mod("%.1f", np.abs(100 * std_dev / mean_value))
+            std_str = np.char.add(std_str, "%")
+        else:
+            std_str = np.char.mod(f"%.{std_digits}f", std_dev)
+        rendered[col] = np.char.add(np.char.add(mean_str, f"{spacer}±"), std_str)
+    return pd.DataFrame(rendered, index=stats.index)
+
+
+@profiled(rows="df")
 def get_cluster_actual_stats(df, cluster_index, scale_param, std_per=False):
-    stats = dict()
     scale_dict = scale_param["scaler"].to_dict()
-
-    for cluster_no, cluster_indx in cluster_index.items():
-        df_temp = get_pref_muni_isin(df, cluster_indx)
-        df_temp = apply_scale(df_temp, scale_dict)
-        df_temp = df_temp[scale_dict.keys()]
-        stats[cluster_no] = calc_n_show_mean_std(df_temp, scale_param, std_per=std_per)
-    stats = pd.DataFrame(stats).T
-    return stats
+    stats = compute_cluster_stats(df, cluster_index, scale_param.index, scale_dict)
+    return render_mean_std(
+        stats,
+        scale_param["mean_sno"].to_dict(),
+        scale_param["std_sno"].to_dict(),
+        spacer=" ",
+        std_per=std_per,
+    )
 
 
 def align_spacing(series):
@@ -71,25 +152,17 @@ def align_spacing(series):
     Used to standardize the output of `format_mean_std` for each column or rows.
     Usage: df.apply(align_spacing, axis=0) for column wise alignment axis =1 for row-wise.
     """
-
-    def extract_length(s):
-        # Extract the part between ± and %
-        match = re.search(r"±\s*(.*?)%", s)
-        if match:
-            return len(match.group(1))
-        return 0
-
-    def pad_string(s, max_length):
-        # Extract the part between ± and %, then pad with spaces
-        match = re.search(r"±\s*(.*?)%", s)
-        if match:
-            current_length = len(match.group(1))
-            padding = " " * (max_length - current_length)
-            return re.sub(r"±\s*(.*?)%", f"±{padding}\\1%", s)
-        return s
-
-    # Find the maximum length of characters between ± and %
-    max_length = series.apply(extract_length).max()
-
-    # Adjust the spacing for each row
-    return series.apply(lambda x: pad_string(x, max_length))
+    pattern = r"±\s*(.*?)%"
+
+    # length of the characters between ± and %, 0 without a match
+    length = series.str.extract(pattern, expand=False).str.len().fillna(0).astype(int)
+    padding = length.max() - length
+
+    # one vectorized replacement per distinct padding
+    aligned = series.copy()
+    for n_pad in padding.unique():
+        rows = padding == n_pad
+        aligned[rows] = series[rows].str.replace(
+            pattern, "±" + " " * n_pad + r"\1%", regex=True
+        )
+    return aligned
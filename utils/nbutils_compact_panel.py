@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+
+from utils.nbutils_load_data import (
+    col_lv_spr,
+    col_pv_cap,
+    col_same_val,
+    extract_wide_arrays,
+    ftr_pref_muni,
+)
+
+
+def compact_float(values):
+    """
+    `values` as float32 (the round trip is within 6e-8 relative error), unchanged if a
+    finite value would overflow float32.
+    """
+    with np.errstate(over="ignore"):
+        values_32 = values.astype(np.float32)
+    overflow = np.isinf(values_32) & np.isfinite(values)
+    return values if overflow.any() else values_32
+
+
+class CompactPanel:
+    """
+    memory-light form of the long panel of `build_df_for_analysis`.
+
+    The year-invariant columns (`pref`, `muni`, `demand`, `land_avail`,
+    `taxable_income`, `pv_out`) are stored once per municipality and the yearly
+    columns (`LV`, `SPR`, `PV_*`) as (year x municipality) arrays. Row `i` of the long
+    panel is municipality `muni_index[i]` in year `years[year_index[i]]`, the same row
+    order as `build_df_for_analysis`. Keys are categoricals and floats are float32.
+    """
+
+    def __init__(self, keys, constant, yearly, years):
+        self.keys = keys
+        self.constant = constant
+        self.yearly = yearly
+        self.years = np.asarray(years)
+
+    @classmethod
+    def from_pv_params(cls, pv_params, years=None, mask=None):
+        arrays = extract_wide_arrays(pv_params, years)
+        rows = slice(None) if mask is None else np.asarray(mask, dtype=bool)
+
+        keys = pd.DataFrame(
+            {c: pd.Categorical(arrays["keys"][c][rows]) for c in ftr_pref_muni}
+        )
+        constant = pd.DataFrame(
+            {c: compact_float(arrays["constant"][c][rows]) for c in col_same_val}
+        )
+
+        yearly = dict()
+        for col in col_lv_spr:
+            yearly[col] = compact_float(arrays["yearly"][col][rows].T)
+        for col in col_pv_cap:
+            pv_cap_y = arrays["yearly"][col][rows]
+            pv_cap_y = 100 * pv_cap_y / np.nansum(pv_cap_y, axis=0)
+            yearly[col] = compact_float(pv_cap_y.T)
+        return cls(keys, constant, yearly, arrays["years"])
+
+    @property
+    def n_muni(self):
+        return len(self.keys)
+
+    @property
+    def n_years(self):
+        return len(self.years)
+
+    def __len__(self):
+        return self.n_muni * self.n_years
+
+    @property
+    def year_index(self):
+        return np.repeat(np.arange(self.n_years), self.n_muni)
+
+    @property
+    def muni_index(self):
+        return np.tile(np.arange(self.n_muni), self.n_years)
+
+    def column(self, col):
+        """
+        one column of the long panel, materialized alone.
+        """
+        if col == "year":
+            return self.years[self.year_index]
+        if col in self.yearly:
+            return self.yearly[col].ravel()
+        if col in self.constant:
+            return self.constant[col].to_numpy()[self.muni_index]
+        return self.keys[col].to_numpy()[self.muni_index]
+
+    def year_slice(self, year, columns=None):
+        """
+        the rows of one year as a dataframe, e.g. for the yearly regressions.
+        """
+        pos = int(np.flatnonzero(self.years == year)[0])
+        df = pd.concat([self.keys, self.constant], axis=1)
+        for col, values in self.yearly.items():
+            df[col] = values[pos]
+        df.insert(0, "year", year)
+        return df if columns is None else df[columns]
+
+    def to_frame(self, columns=None):
+        """
+        the long panel with the columns of `build_df_for_analysis`.
+        """
+        if columns is None:
+            columns = ["year"] + ftr_pref_muni + col_same_val + col_lv_spr + col_pv_cap
+        return pd.DataFrame({col: self.column(col) for col in columns})
+
+    def memory_usage(self):
+        """
+        bytes used by each stored column, with the total and the size of the same panel
+        as a materialized float64/object dataframe.
+        """
+        usage = dict()
+        for col in ftr_pref_muni:
+            usage[col] = self.keys[col].memory_usage(deep=True, index=False)
+        for col in col_same_val:
+            usage[col] = self.constant[col].to_numpy().nbytes
+        for col, values in self.yearly.items():
+            usage[col] = values.nbytes
+        usage = pd.Series(usage, dtype="int64")
+        usage["total"] = usage.sum()
+
+        keys_object = self.keys.astype(object).memory_usage(deep=True, index=False)
+        n_float = len(col_same_val) + len(self.yearly)
+        usage["dense_float64"] = len(self) * 8 * (n_float + 1) + (
+            keys_object.sum() * self.n_years
+        )
+        return usage
@@ -1,9 +1,10 @@
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.stats import pearsonr, spearmanr
+from scipy.stats import t as t_dist
 
-from utils.japan_admin_data import prefecture_dict_en_to_no, prefecture_dict_jp_to_en
+from utils.nbutils_growth import growth_rates, pref_growth_table
+from utils.nbutils_profile import profiled
 
 
 def plot_demand_cap_corr(demand, pv_cap, axs=None, ylabel=None, xlabel=None):
@@ -42,33 +43,65 @@ def plot_demand_cap_corr(demand, pv_cap, axs=None, ylabel=None, xlabel=None):
     return fig, axs
 
 
-def plot_corr_matrix_with_p_values(
-    df, method="pearson", figsize=(10, 8), title="Correlation Matrix Heatmap"
-):
+@profiled(rows="df")
+def compute_corr_with_p_values(df, method="pearson"):
+    """
+    correlation matrix and two-sided p-value matrix of the columns of `df`, computed in
+    one vectorized pass. Spearman is the Pearson correlation of the ranks, so the data
+    is ranked once. The p-values come from the t-distribution with n - 2 degrees of
+    freedom (the same test as `pearsonr`/`spearmanr`) and are computed for the upper
+    triangle only. Rows with a missing value are dropped. The diagonal of the p-value
+    matrix is NaN.
+    """
     # Validate the method parameter
     if method not in ["pearson", "spearman"]:
         raise ValueError("Method must be either 'pearson' or 'spearman'")
 
-    # Calculate correlation matrix
-    correlation_matrix = df.corr(method=method)
+    df_values = df.dropna()
+    if method == "spearman":
+        df_values = df_values.rank()
+    values = df_values.to_numpy(dtype=float)
+    n, k = values.shape
+
+    # correlation of the standardized columns
+    centered = values - values.mean(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        normed = centered / np.sqrt((centered**2).sum(axis=0))
+    corr = np.clip(normed.T @ normed, -1, 1)
+    np.fill_diagonal(corr, 1)
+
+    # p-values of the upper triangle, mirrored to the lower one
+    iu = np.triu_indices(k, 1)
+    r = corr[iu]
+    dof = n - 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_stat = r * np.sqrt(dof / ((1 - r) * (1 + r)))
+    p_values = 2 * t_dist.sf(np.abs(t_stat), dof)
+    p_matrix = np.full((k, k), np.nan)
+    p_matrix[iu] = p_values
+    p_matrix[iu[::-1]] = p_values
+
+    correlation_matrix = pd.DataFrame(corr, columns=df.columns, index=df.columns)
+    p_matrix = pd.DataFrame(p_matrix, columns=df.columns, index=df.columns)
+    return correlation_matrix, p_matrix
 
-    # Initialize a matrix for p-values
-    p_matrix = pd.DataFrame(
-        np.zeros_like(correlation_matrix), columns=df.columns, index=df.columns
+
+def plot_corr_matrix_with_p_values(
+    df, method="pearson", figsize=(10, 8), title="Correlation Matrix Heatmap"
+):
+    correlation_matrix, p_matrix = compute_corr_with_p_values(df, method=method)
+    return plot_corr_p_matrix(
+        correlation_matrix, p_matrix, method=method, figsize=figsize, title=title
     )
 
-    # Calculate p-values
-    for i in range(len(correlation_matrix.columns)):
-        for j in range(len(correlation_matrix.columns)):
-            if i == j:
-                p_matrix.iloc[i, j] = np.nan
-            else:
-                if method == "pearson":
-                    _, p_value = pearsonr(df.iloc[:, i], df.iloc[:, j])
-                elif method == "spearman":
-                    _, p_value = spearmanr(df.iloc[:, i], df.iloc[:, j])
-                p_matrix.iloc[i, j] = p_value
 
+def plot_corr_p_matrix(
+    correlation_matrix,
+    p_matrix,
+    method="pearson",
+    figsize=(10, 8),
+    title="Correlation Matrix Heatmap",
+):
     fig, ax = plt.subplots(figsize=figsize)
 
     # Adjust alpha of the colormap
@@ -158,45 +191,26 @@ def plot_corr_matrix(correlation_matrix, figsize=(10, 8)):
 
 
 def plot_growth_rate(pv_params, pv_cols, ylim=None, ylabel=None, barcolor="blue"):
-    pv_params_pref_cap = pv_params[["pref"] + pv_cols]
-    pv_params_pref_cap = pv_params_pref_cap.groupby("pref").sum()
-    pv_params_pref_cap.index = pv_params_pref_cap.index.map(prefecture_dict_jp_to_en)
-    jp_mean_pct_change = pv_params_pref_cap.sum().pct_change().mean()
+    """
+    mean yearly growth of the capacity of each prefecture for the `{pv_type}_{year}`
+    columns `pv_cols`, with the national mean and the 1.64 std band. The numbers come
+    from `growth_rates`.
+    """
+    pv_type = pv_cols[0].rsplit("_", 1)[0]
+    years = [int(c.rsplit("_", 1)[1]) for c in pv_cols]
+    stats = growth_rates(pv_params, [pv_type], levels=["pref"], years=years)
+    national = stats["national"].iloc[0]
+    growth_rate = pref_growth_table(stats["summary"], pv_type)
+
+    jp_mean_pct_change = national["mean_growth"]
+    std_growth_rate = national["pref_std_growth"]
     print("Japan Mean PCT Change:", jp_mean_pct_change)
-
-    dfx = pv_params_pref_cap.copy()
-
-    # Calculate the yearly growth rate
-    growth_rate = dfx.pct_change(axis=1)
-
-    # Fill any NaN values that arise from percentage change calculation (first column will be NaN)
-    growth_rate.fillna(0, inplace=True)
-
-    # Calculate the mean growth rate for each prefecture
-    growth_rate["mean_growth"] = growth_rate.iloc[:, 1:].mean(axis=1)
-
-    # Calculate the mean and standard deviation of the mean growth rates
-    mean_growth_rate = growth_rate["mean_growth"].mean()
-    std_growth_rate = growth_rate["mean_growth"].std()
-    print("Prefecture Mean PCT Change:", mean_growth_rate)
-    # print("Prefecture Var PCT Change:", growth_rate['mean_growth'].var())
-    print("Prefecture Std PCT Change:", growth_rate["mean_growth"].std())
-
-    # Compute the Z-score for each prefecture's mean growth rate
-    growth_rate["z_score"] = (
-        growth_rate["mean_growth"] - mean_growth_rate
-    ) / std_growth_rate
-
-    # Define a threshold for identifying outliers (e.g., Z-score > 1.64 for a 90% confidence interval)
-    z_score_threshold = 1.64
-
-    growth_rate["id"] = growth_rate.index.map(prefecture_dict_en_to_no)
-    growth_rate = growth_rate.sort_values("id")
+    print("Prefecture Mean PCT Change:", national["pref_mean_growth"])
+    print("Prefecture Std PCT Change:", std_growth_rate)
 
     fig, ax = plt.subplots(1, 1)
     fig.set_size_inches(10, 4)
     growth_rate["mean_growth"].mul(100).plot(ax=ax, kind="bar", color=barcolor)
-    ax.axhline(y=jp_mean_pct_change * 100, color="k", ls=":")
     ax.set_xlabel(None)
     ax.set_ylabel(ylabel)
     ax.set_ylim(ylim)
@@ -204,11 +218,6 @@ def plot_growth_rate(pv_params, pv_cols, ylim=None, ylabel=None, barcolor="blue"
     ax.axhline(y=(jp_mean_pct_change - 1.64 * std_growth_rate) * 100, color="r", ls=":")
     ax.axhline(y=(jp_mean_pct_change + 1.64 * std_growth_rate) * 100, color="r", ls=":")
 
-    ax.axhline(y=jp_mean_pct_change * 100, color="k", ls=":")
-    growth_rate[
-        ~growth_rate["z_score"].between(-z_score_threshold, z_score_threshold)
-    ].sort_values("z_score")
-
     return fig, ax
 
 
@@ -0,0 +1,211 @@
+"""
+Estimators by name for the yearly regressions, the outlier detection and the SHAP
+stage, and a comparison of them on the same data.
+
+`make_estimator("rf")` is the `RandomForestRegressor` used so far; "hgb" is a
+`HistGradientBoostingRegressor` and "ridge", "lasso" and "elasticnet" are regularized
+linear models behind a `StandardScaler`. Lasso and elastic net choose their `alpha`
+by cross-validation: with shares of about 0.01-0.1 the default `alpha=1.0` sets every
+coefficient to 0. Classifiers (the RFC of the SHAP stage) have their own table. New
+backends are added with `register_estimator`.
+"""
+
+import io
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import (
+    HistGradientBoostingClassifier,
+    HistGradientBoostingRegressor,
+    RandomForestClassifier,
+    RandomForestRegressor,
+)
+from sklearn.inspection import permutation_importance
+from sklearn.linear_model import ElasticNetCV, LassoCV, LogisticRegression, Ridge
+from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
+from sklearn.model_selection import train_test_split
+from sklearn.pipeline import Pipeline, make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.base import clone
+
+from utils.nbutils_profile import profiled
+
+
+def _scaled(estimator):
+    # linear models see standardized features, so their coefficients are comparable
+    return lambda: make_pipeline(StandardScaler(), estimator())
+
+
+estimators = {
+    "regressor": {
+        "rf": RandomForestRegressor,
+        "hgb": HistGradientBoostingRegressor,
+        "ridge": _scaled(Ridge),
+        "lasso": _scaled(LassoCV),
+        "elasticnet": _scaled(ElasticNetCV),
+    },
+    "classifier": {
+        "rf": RandomForestClassifier,
+        "hgb": HistGradientBoostingClassifier,
+        "logistic": _scaled(LogisticRegression),
+    },
+}
+
+
+def register_estimator(name, factory, kind="regressor"):
+    """
+    adds `factory` (a callable without arguments returning an unfitted estimator)
+    under `name`.
+    """
+    estimators[kind][name] = factory
+
+
+def final_estimator(model):
+    return model[-1] if isinstance(model, Pipeline) else model
+
+
+def make_estimator(name, kind="regressor", random_state=None, n_jobs=None, **params):
+    """
+    a new estimator of the backend `name`. `random_state` and `n_jobs` are set when
+    the estimator has them; `params` are set on the estimator (the final step of a
+    pipeline) and must exist.
+    """
+    if name not in estimators[kind]:
+        raise ValueError(
+            f"unknown {kind} backend: {name}, available: {sorted(estimators[kind])}"
+        )
+    model = estimators[kind][name]()
+    prefix = f"{model.steps[-1][0]}__" if isinstance(model, Pipeline) else ""
+    available = model.get_params()
+
+    common = {"random_state": random_state, "n_jobs": n_jobs}
+    for key, value in common.items():
+        if value is not None and prefix + key in available:
+            model.set_params(**{prefix + key: value})
+    model.set_params(**{prefix + key: value for key, value in params.items()})
+    return model
+
+
+def native_importances(model):
+    """
+    `feature_importances_` of tree models or `coef_` of linear models (of the final
+    step of a pipeline), None when the model has neither.
+    """
+    model = final_estimator(model)
+    if hasattr(model, "feature_importances_"):
+        return np.asarray(model.feature_importances_)
+    if hasattr(model, "coef_"):
+        coef = np.asarray(model.coef_)
+        return coef if coef.ndim == 1 else np.abs(coef).mean(axis=0)
+    return None
+
+
+def feature_importances(
+    model, X, y, method="auto", n_repeats=5, random_state=42, n_jobs=-1
+):
+    """
+    importance of each column of `X` for the fitted `model`: the native importances
+    (method="native"), the mean decrease of the score when the column is shuffled,
+    computed in parallel over the columns (method="permutation"), or the native ones
+    when available and the permutation ones otherwise (method="auto").
+    """
+    if method not in ["auto", "native", "permutation"]:
+        raise ValueError(f"unknown importance method: {method}")
+    importances = None if method == "permutation" else native_importances(model)
+    if importances is None:
+        if method == "native":
+            raise ValueError(f"{type(model).__name__} has no native importances")
+        importances = permutation_importance(
+            model,
+            X,
+            y,
+            n_repeats=n_repeats,
+            random_state=random_state,
+            n_jobs=n_jobs,
+        ).importances_mean
+    return pd.Series(importances, index=list(X.columns))
+
+
+def model_size(model):
+    """
+    bytes of the model dumped as the pipeline stores it (joblib, compress=3).
+    """
+    buffer = io.BytesIO()
+    joblib.dump(model, buffer, compress=3)
+    return buffer.getbuffer().nbytes
+
+
+@profiled(rows="df")
+def compare_estimators(
+    df,
+    vars_iv,
+    var_dv,
+    names=("rf", "hgb", "ridge", "lasso", "elasticnet"),
+    years=None,
+    iv_scaler=None,
+    dv_scaler=None,
+    importance="permutation",
+    random_state=42,
+    n_jobs=-1,
+):
+    """
+    fits every backend of `names` on the same per-year train/test splits as
+    `regression_analysis_yearly` and reports, per backend and year, the fit time,
+    the prediction throughput on the whole year (rows/s), the size of the dumped
+    model, the test metrics and the importances (`{var}_importance`, permutation
+    importances on the test rows by default so that all backends are measured the
+    same way).
+    """
+    from utils.nbutils_regression import scale_data
+
+    if years is None:
+        years = sorted(df["year"].unique())
+
+    report = []
+    for year in years:
+        df_y, _, _ = scale_data(
+            df[df["year"] == year].copy(),
+            vars_iv,
+            var_dv,
+            None if iv_scaler is None else clone(iv_scaler),
+            None if dv_scaler is None else clone(dv_scaler),
+        )
+        X, y = df_y[vars_iv], df_y[var_dv]
+        X_train, X_test, y_train, y_test = train_test_split(
+            X, y, test_size=0.2, random_state=42
+        )
+        for name in names:
+            model = make_estimator(name, random_state=random_state, n_jobs=n_jobs)
+
+            start = time.perf_counter()
+            model.fit(X_train, y_train)
+            fit_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            model.predict(X)
+            predict_time = time.perf_counter() - start
+
+            y_pred = model.predict(X_test)
+            importances = feature_importances(
+                model,
+                X_test,
+                y_test,
+                method=importance,
+                random_state=random_state,
+                n_jobs=n_jobs,
+            )
+            row = {
+                "backend": name,
+                "year": year,
+                "fit_time": fit_time,
+                "predict_rows_per_s": len(X) / predict_time,
+                "model_bytes": model_size(model),
+                "r2": r2_score(y_test, y_pred),
+                "mae": mean_absolute_error(y_test, y_pred),
+                "rmse": np.sqrt(mean_squared_error(y_test, y_pred)),
+            }
+            row.update({f"{c}_importance": v for c, v in importances.items()})
+            report.append(row)
+    return pd.DataFrame(report)
@@ -0,0 +1,137 @@
+"""
+Growth rates of the installed PV capacity, without plotting (notebook 01).
+
+The `{pv_type}_{year}` columns of every PV type are summed per group in one pass, for
+prefectures, municipalities or clusters, and the yearly growth rates, their mean per
+group, the z-score of that mean among the groups and the outlier flag of
+`plot_growth_rate` are computed for all PV types at once. Results are tidy frames with
+one row per (level, group, PV type[, year]).
+"""
+
+import numpy as np
+import pandas as pd
+
+from utils.japan_admin_data import prefecture_dict_jp_to_en, prefecture_dict_r
+from utils.nbutils_cluster_stats import cluster_rows
+from utils.nbutils_load_data import col_pv_cap, get_data_years
+from utils.nbutils_profile import profiled
+
+growth_levels = ["pref", "muni", "cluster"]
+key_cols = ["pref", "muni", "cluster"]
+
+
+def _group_sums(pv_params, values, level, clusters):
+    # capacity sums per group (n_groups x n_columns) and the key columns of the groups
+    if level == "muni":
+        return values, pv_params[["pref", "muni"]].reset_index(drop=True)
+    if level == "pref":
+        labels = pv_params["pref"].to_numpy()
+    elif level == "cluster":
+        if clusters is None:
+            raise ValueError("the cluster level needs `clusters`")
+        if isinstance(clusters, dict):
+            rows, labels = cluster_rows(pv_params, clusters)
+            values = values[rows]
+        else:
+            labels = np.asarray(clusters)
+    else:
+        raise ValueError(f"unknown aggregation level: {level}")
+
+    sums = pd.DataFrame(values).groupby(labels, sort=True).sum()
+    return sums.to_numpy(), pd.DataFrame({level: sums.index})
+
+
+def _pct_change(cap):
+    # growth between consecutive years along the last axis. As in `plot_growth_rate`,
+    # no capacity in either year counts as no growth and a start from zero is infinite.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        growth = cap[..., 1:] / cap[..., :-1] - 1
+    return np.where(np.isnan(growth), 0, growth)
+
+
+@profiled(rows="pv_params")
+def growth_rates(
+    pv_params,
+    pv_types=col_pv_cap,
+    levels=("pref",),
+    clusters=None,
+    years=None,
+    z_score_threshold=1.64,
+):
+    """
+    growth rates of the capacity of `pv_types` in `pv_params` (the wide table of
+    `load_and_process_data`) aggregated at each of `levels`: "pref", "muni" and
+    "cluster". `clusters` gives the cluster of each row of `pv_params` or is a
+    cluster_index dict of cluster number -> (pref, muni) keys.
+
+    Returns a dict of tidy frames:
+    `growth`: capacity and growth rate per level, group, PV type and year;
+    `summary`: mean growth per level, group and PV type, its z-score among the groups
+    of the level and `outlier` when |z| > `z_score_threshold`;
+    `national`: per PV type, the mean growth of the national total and the mean and
+    std of the group mean growths of each level.
+    Groups whose capacity starts from zero have an infinite mean growth; they are left
+    out of the z-scores and are not flagged.
+    """
+    pv_types = list(pv_types)
+    years = get_data_years(pv_params) if years is None else list(years)
+    columns = [f"{pv_type}_{year}" for pv_type in pv_types for year in years]
+    values = np.nan_to_num(pv_params[columns].to_numpy(dtype=np.float64))
+    n_types, n_years = len(pv_types), len(years)
+
+    national_cap = values.sum(axis=0).reshape(n_types, n_years)
+    national = pd.DataFrame(
+        {"pv_type": pv_types, "mean_growth": _pct_change(national_cap).mean(axis=1)}
+    )
+
+    growth, summary = [], []
+    for level in levels:
+        sums, keys = _group_sums(pv_params, values, level, clusters)
+        cap = sums.reshape(len(sums), n_types, n_years)
+        rate = _pct_change(cap)
+        mean_growth = rate.mean(axis=2)
+
+        finite = np.where(np.isfinite(mean_growth), mean_growth, np.nan)
+        level_mean = np.nanmean(finite, axis=0)
+        level_std = np.nanstd(finite, axis=0, ddof=1)
+        z_score = (finite - level_mean) / level_std
+        national[f"{level}_mean_growth"] = level_mean
+        national[f"{level}_std_growth"] = level_std
+
+        keys = keys.reindex(columns=key_cols)
+        keys.insert(0, "level", level)
+        n_groups = len(keys)
+
+        df_summary = keys.loc[np.repeat(np.arange(n_groups), n_types)]
+        df_summary["pv_type"] = np.tile(pv_types, n_groups)
+        df_summary["mean_growth"] = mean_growth.ravel()
+        df_summary["z_score"] = z_score.ravel()
+        df_summary["outlier"] = np.abs(df_summary["z_score"]) > z_score_threshold
+        summary.append(df_summary)
+
+        # the first year has no growth rate, as the 0 of `plot_growth_rate`
+        rate = np.concatenate([np.zeros((n_groups, n_types, 1)), rate], axis=2)
+        df_growth = keys.loc[np.repeat(np.arange(n_groups), n_types * n_years)]
+        df_growth["pv_type"] = np.tile(np.repeat(pv_types, n_years), n_groups)
+        df_growth["year"] = np.tile(years, n_groups * n_types)
+        df_growth["capacity"] = cap.ravel()
+        df_growth["growth_rate"] = rate.ravel()
+        growth.append(df_growth)
+
+    return {
+        "growth": pd.concat(growth, ignore_index=True),
+        "summary": pd.concat(summary, ignore_index=True),
+        "national": national,
+    }
+
+
+def pref_growth_table(summary, pv_type):
+    """
+    the prefecture rows of `summary` for one PV type as plotted by
+    `plot_growth_rate`: indexed by the english name, in prefecture number order.
+    """
+    df = summary[(summary["level"] == "pref") & (summary["pv_type"] == pv_type)]
+    df = df[["pref", "mean_growth", "z_score", "outlier"]].copy()
+    df["id"] = df["pref"].map(prefecture_dict_r)
+    df.index = df.pop("pref").map(prefecture_dict_jp_to_en)
+    return df.sort_values("id")
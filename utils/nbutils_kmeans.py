@@ -0,0 +1,350 @@
+"""
+KMeans clustering of the SHAP scores (notebook 03a) and the sweep over the number of
+clusters used to choose it.
+
+`kmeans_sweep` fits k = 1, 2, ... as one chain, each k initialized with the centroids
+of k - 1 plus one centroid drawn by k-means++ weighting, and switches to
+`MiniBatchKMeans` above `minibatch_threshold` rows. The warm start alone can end in a
+worse local optimum than a fresh fit, so every k is also fitted from scratch as in the
+notebook, in parallel over k, and the chain keeps and continues from the better of
+the two. Alongside the inertia (elbow) it computes the silhouette on one sample shared
+by every k and a consensus stability over refits on random subsamples, also in
+parallel over k. `cluster_shap_scores` is the final clustering of the notebook with
+the clusters ordered by their mean `{vars_dv}_shap`.
+"""
+
+import hashlib
+import json
+import os
+
+import joblib
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import (
+    adjusted_rand_score,
+    pairwise_distances,
+    pairwise_distances_argmin_min,
+)
+
+from utils.nbutils_profile import profiled
+from utils.nbutils_shap import data_hash
+
+columns_for_clustering = [
+    "demand_score",
+    "land_avail_score",
+    "taxable_income_score",
+    "LV_score",
+    "SPR_score",
+    "pv_out_score",
+]
+
+
+def _kmeans(n_rows, minibatch_threshold, n_init=1, **params):
+    if n_rows > minibatch_threshold:
+        return MiniBatchKMeans(batch_size=1024, n_init=n_init, **params)
+    return KMeans(n_init=n_init, **params)
+
+
+def _fresh_job(X, k, n_init, minibatch_threshold, random_state):
+    # the fit of the notebook loop, `KMeans(n_clusters=k, random_state=42)`
+    model = _kmeans(
+        len(X),
+        minibatch_threshold,
+        n_init=n_init,
+        n_clusters=k,
+        random_state=random_state,
+    ).fit(X)
+    return model.cluster_centers_, model.labels_, model.inertia_
+
+
+def _next_init(X, centers, rng):
+    # the centroids of the previous k and one new point drawn with probability
+    # proportional to its squared distance to them (the k-means++ step)
+    if centers is None:
+        return X[rng.integers(len(X))][None, :]
+    dist = pairwise_distances_argmin_min(X, centers)[1] ** 2
+    if dist.sum() == 0:
+        return np.vstack([centers, X[rng.integers(len(X))]])
+    return np.vstack([centers, X[rng.choice(len(X), p=dist / dist.sum())]])
+
+
+def _silhouette(distances, labels):
+    # silhouette_score(metric="precomputed") with the per-cluster distance sums of
+    # every row computed as one product with the one-hot labels
+    codes, labels = np.unique(labels, return_inverse=True)
+    one_hot = np.zeros((len(labels), len(codes)))
+    one_hot[np.arange(len(labels)), labels] = 1
+    sums = distances @ one_hot
+    sizes = one_hot.sum(axis=0)
+    rows = np.arange(len(labels))
+
+    own_size = sizes[labels]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        a = sums[rows, labels] / (own_size - 1)
+        mean_other = sums / sizes
+        mean_other[rows, labels] = np.inf
+        b = mean_other.min(axis=1)
+        s = (b - a) / np.maximum(a, b)
+    # rows alone in their cluster count as 0
+    return float(np.mean(np.where(own_size > 1, np.nan_to_num(s), 0)))
+
+
+def _consensus_job(
+    X,
+    k,
+    labels,
+    silhouette_rows,
+    distances,
+    n_replicates,
+    subsample,
+    minibatch_threshold,
+    seed,
+):
+    """
+    silhouette of `labels` on the sample `silhouette_rows`, whose pairwise `distances`
+    are shared by every k, and the stability of k over refits on random subsamples:
+    the mean adjusted Rand index with `labels` and the proportion of ambiguous pairs
+    (PAC) of the consensus matrix.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = len(X)
+    if k == 1:
+        return np.nan, 1.0, 0.0
+
+    silhouette = _silhouette(distances, labels[silhouette_rows])
+
+    # consensus is measured on a fixed sample of rows to bound the pair matrix
+    rows = rng.choice(n_rows, min(n_rows, subsample["consensus"]), replace=False)
+    n_sample = len(rows)
+    together = np.zeros((n_sample, n_sample))
+    sampled = np.zeros((n_sample, n_sample))
+    aris = []
+    for _ in range(n_replicates):
+        fit_rows = rng.random(n_rows) < subsample["fraction"]
+        model = _kmeans(
+            fit_rows.sum(),
+            minibatch_threshold,
+            n_clusters=k,
+            random_state=int(rng.integers(2**31 - 1)),
+        )
+        model.fit(X[fit_rows])
+        aris.append(adjusted_rand_score(labels[fit_rows], model.labels_))
+
+        in_fit = fit_rows[rows]
+        rep_labels = model.predict(X[rows])
+        both = in_fit[:, None] & in_fit[None, :]
+        sampled += both
+        together += both & (rep_labels[:, None] == rep_labels[None, :])
+
+    with np.errstate(invalid="ignore"):
+        consensus = together / sampled
+    upper = np.triu_indices(n_sample, 1)
+    consensus = consensus[upper][~np.isnan(consensus[upper])]
+    pac = np.mean((consensus > 0.1) & (consensus < 0.9))
+    return silhouette, float(np.mean(aris)), float(pac)
+
+
+def _sweep_key(X, params):
+    h = hashlib.sha256()
+    h.update(data_hash(pd.DataFrame(X)).encode())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()[:16]
+
+
+@profiled(rows="X")
+def kmeans_sweep(
+    X,
+    k_values=range(1, 15),
+    random_state=42,
+    n_init=1,
+    minibatch_threshold=20_000,
+    silhouette_sample=2_000,
+    n_replicates=10,
+    consensus_sample=1_000,
+    subsample_fraction=0.8,
+    n_jobs=-1,
+    cache_dir=None,
+):
+    """
+    elbow, silhouette and stability metrics of KMeans on `X` for every k in `k_values`.
+    Returns a dict with `metrics` (a dataframe indexed by k with `inertia`,
+    `silhouette`, `stability_ari` and `pac`; lower PAC is more stable) and `centers`
+    (k -> centroids). The inertia of each k is the better of the warm-started fit and
+    a fresh fit with `n_init` inits and `random_state`, so it is never above the one
+    of the notebook loop (`n_init=0` keeps only the warm start, whose inertias are
+    then upper bounds of the optimal ones). With `cache_dir`, the result is stored
+    keyed by the data and the parameters and reused.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    k_values = sorted(k_values)
+    params = {
+        "k_values": k_values,
+        "random_state": random_state,
+        "n_init": n_init,
+        "minibatch_threshold": minibatch_threshold,
+        "silhouette_sample": silhouette_sample,
+        "n_replicates": n_replicates,
+        "consensus_sample": consensus_sample,
+        "subsample_fraction": subsample_fraction,
+    }
+    if cache_dir is not None:
+        fn = os.path.join(cache_dir, f"kmeans-sweep-{_sweep_key(X, params)}.joblib")
+        if os.path.exists(fn):
+            return joblib.load(fn)
+
+    seeds = np.random.SeedSequence(random_state).spawn(len(k_values) + 1)
+    rng = np.random.default_rng(seeds[0])
+    subsample = {"consensus": consensus_sample, "fraction": subsample_fraction}
+
+    with Parallel(
+        n_jobs=min(effective_n_jobs(n_jobs), len(k_values)), return_as="generator"
+    ) as parallel:
+        # the fresh fits are independent of each other and run in the pool while the
+        # chain, the only serial part, waits for them one k at a time
+        fresh_k = [k for k in k_values if k > 1] if n_init > 0 else []
+        fresh_fits = parallel(
+            delayed(_fresh_job)(X, k, n_init, minibatch_threshold, random_state)
+            for k in fresh_k
+        )
+
+        # warm-started chain over k
+        centers, labels, inertia = dict(), dict(), dict()
+        init = None
+        for k in range(1, k_values[-1] + 1):
+            init = _next_init(X, init, rng)
+            model = _kmeans(
+                len(X),
+                minibatch_threshold,
+                n_clusters=k,
+                init=init,
+                random_state=int(rng.integers(2**31 - 1)),
+            )
+            model.fit(X)
+            best = model.cluster_centers_, model.labels_, model.inertia_
+            if k in fresh_k:
+                fresh = next(fresh_fits)
+                if fresh[2] < best[2]:
+                    best = fresh
+            init = best[0]
+            if k in k_values:
+                centers[k], labels[k], inertia[k] = best
+
+        # every fresh fit was consumed, the generator is released to reuse the pool
+        del fresh_fits
+
+        # one silhouette sample for every k, its distances computed once
+        silhouette_rows = np.sort(
+            rng.choice(len(X), min(len(X), silhouette_sample), replace=False)
+        )
+        distances = pairwise_distances(X[silhouette_rows])
+        outputs = list(
+            parallel(
+                delayed(_consensus_job)(
+                    X,
+                    k,
+                    labels[k],
+                    silhouette_rows,
+                    distances,
+                    n_replicates,
+                    subsample,
+                    minibatch_threshold,
+                    seed,
+                )
+                for k, seed in zip(k_values, seeds[1:])
+            )
+        )
+
+    metrics = pd.DataFrame(
+        outputs, index=k_values, columns=["silhouette", "stability_ari", "pac"]
+    )
+    metrics.insert(0, "inertia", pd.Series(inertia))
+    metrics.index.name = "k"
+    result = {"metrics": metrics, "centers": centers}
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        joblib.dump(result, fn + ".tmp")
+        os.replace(fn + ".tmp", fn)
+    return result
+
+
+def plot_kmeans_sweep(metrics, axs=None):
+    """
+    the elbow curve of notebook 03a next to the silhouette and the stability.
+    """
+    import matplotlib.pyplot as plt
+
+    if axs is None:
+        fig, axs = plt.subplots(1, 3, figsize=(15, 4))
+    for ax, col, title in zip(
+        axs,
+        ["inertia", "silhouette", "pac"],
+        ["Elbow Curve for Optimal k", "Silhouette (sampled)", "Consensus PAC"],
+    ):
+        ax.plot(metrics.index, metrics[col], marker="o", linestyle="-", color="b")
+        ax.set_title(title)
+        ax.set_xlabel("Number of Clusters (k)")
+        ax.set_xticks(metrics.index)
+        ax.grid(True)
+    axs[0].set_ylabel("Inertia")
+    return axs
+
+
+def cluster_shap_scores(
+    shap_scores_summary_df,
+    vars_dv,
+    optimal_k,
+    columns=columns_for_clustering,
+    random_state=42,
+    cache_dir=None,
+):
+    """
+    adds `kmeans_cluster` to the SHAP summary: `KMeans(n_clusters=optimal_k)` on the
+    score columns, with the clusters renumbered by decreasing mean `{vars_dv}_shap`,
+    as in notebook 03a. With `cache_dir`, the labels are stored keyed by the scores and
+    the parameters.
+    """
+    X = shap_scores_summary_df[columns]
+    params = {"optimal_k": optimal_k, "random_state": random_state}
+    labels = None
+    if cache_dir is not None:
+        fn = os.path.join(cache_dir, f"kmeans-{_sweep_key(X, params)}.npy")
+        if os.path.exists(fn):
+            labels = np.load(fn)
+
+    if labels is None:
+        kmeans = KMeans(n_clusters=optimal_k, random_state=random_state)
+        labels = kmeans.fit_predict(X)
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(fn + ".tmp", "wb") as f:
+                np.save(f, labels)
+            os.replace(fn + ".tmp", fn)
+
+    shap_scores_summary_df["kmeans_cluster"] = labels
+
+    # reorder the clustering based on the mean value in the cluster
+    kmeans_order = (
+        shap_scores_summary_df.groupby("kmeans_cluster")[f"{vars_dv}_shap"]
+        .mean()
+        .sort_values(ascending=False)
+        .index.to_list()
+    )
+    kmeans_reorder_dict = dict(zip(kmeans_order, range(len(shap_scores_summary_df))))
+    shap_scores_summary_df["kmeans_cluster"] = shap_scores_summary_df[
+        "kmeans_cluster"
+    ].map(kmeans_reorder_dict)
+    return shap_scores_summary_df
+
+
+def get_cluster_index(shap_scores_summary_df):
+    """
+    cluster number -> list of the (pref, muni) of its municipalities, the input of
+    `get_pref_muni_isin` and `get_cluster_actual_stats`.
+    """
+    cluster_index = dict()
+    for kmean_no, df_g in shap_scores_summary_df.groupby("kmeans_cluster"):
+        cluster_index[kmean_no] = list(zip(df_g["pref"], df_g["muni"]))
+    return cluster_index
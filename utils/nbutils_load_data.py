@@ -1,18 +1,86 @@
 import pandas as pd
 import numpy as np
 import os
+import re
+
+from utils.nbutils_cache import (
+    as_categorical,
+    cache_key,
+    read_cached_frame,
+    read_latest_cached_frame,
+    write_cached_frame,
+)
+from utils.nbutils_profile import profiled, span
+
+
+@profiled(rows=lambda out: len(out[0]))
+def load_and_process_data(
+    folder, build_df=True, cache_dir=None, categorical=False, incremental=False
+):
+    """
+    loads `pv_muni_params.csv` from `folder` and builds the long panel for analysis.
+    If `cache_dir` is given, the processed frames are cached there as feather files keyed
+    by the content of the csv and of the processing code, and reused while both are
+    unchanged. `categorical` returns `pref`/`muni` as categoricals, cached or not.
+
+    With `incremental`, a csv change does not rebuild the whole panel: the previously
+    cached panel is kept for the years it already has and only the slices of newly
+    present years are appended. Use it when the change is a new year of data, not a
+    correction of earlier years.
+    """
+    fileloc = os.path.join(folder, "pv_muni_params.csv")
 
+    if cache_dir is not None:
+        key = cache_key(fileloc)
+        pv_params = read_cached_frame(cache_dir, "pv_params", key, categorical)
+        df = read_cached_frame(cache_dir, "df", key, categorical) if build_df else None
+        if pv_params is not None and (df is not None or not build_df):
+            return pv_params, df
 
-def load_and_process_data(folder, build_df=True):
-    fileloc = os.path.join(folder, "pv_muni_params.csv")
-    # definitions
-    ftr_pref_muni = ["pref", "muni"]
+    df_prev = None
+    if cache_dir is not None and incremental and build_df:
+        df_prev = read_latest_cached_frame(cache_dir, "df")
+
+    if df_prev is None:
+        pv_params, df = _load_and_process_data(fileloc, build_df)
+    else:
+        pv_params, _ = _load_and_process_data(fileloc, build_df=False)
+        df, _ = extend_df_for_analysis(pv_params, df_prev)
 
+    if cache_dir is not None:
+        write_cached_frame(cache_dir, "pv_params", key, pv_params)
+        if df is not None:
+            write_cached_frame(cache_dir, "df", key, df)
+
+    if categorical:
+        pv_params = as_categorical(pv_params)
+        df = None if df is None else as_categorical(df)
+    return pv_params, df
+
+
+def _load_and_process_data(fileloc, build_df=True):
     # load files
-    pv_params = pd.read_csv(fileloc)
+    with span("nbutils_load_data.read_csv") as s:
+        pv_params = pd.read_csv(fileloc)
+        s.rows = len(pv_params)
+    pv_params = process_pv_params(pv_params)
 
+    # build the dataframe for analysis
+    if build_df:
+        df = build_df_for_analysis(pv_params)
+    else:
+        df = None
+
+    return pv_params, df
+
+
+@profiled(rows=len)
+def process_pv_params(pv_params):
+    """
+    adds the derived columns `PV_A_{year}` and `land_avail` to the raw table.
+    """
     # compute for total
-    for year in range(2014, 2024):
+    for year in get_data_years(pv_params):
         pv_params[f"PV_A_{year}"] = pv_params.filter(regex=rf"^PV_.*_{year}$").sum(
             axis=1
         )
@@ -23,55 +91,119 @@ def load_and_process_data(folder, build_df=True):
         - pv_params["land_buildings"]
         - pv_params["land_agri"]
     )
+    return pv_params
 
-    # build the dataframe for analysis
-    if build_df:
-        df = build_df_for_analysis(pv_params)
-    else:
-        df = None
 
-    return pv_params, df
+# columns of the long panel built by `build_df_for_analysis`
+ftr_pref_muni = ["pref", "muni"]
+col_same_val = ["demand", "land_avail", "taxable_income", "pv_out"]
+col_lv_spr = ["LV", "SPR"]
+col_pv_cap = ["PV_R", "PV_S", "PV_M", "PV_U", "PV_A"]
+
 
+def get_data_years(pv_params):
+    """
+    years with a complete set of `PV_{R,S,M,U}_{year}`, `LV_{year}` and `SPR_{year}`
+    columns in `pv_params`.
+    """
+    years = None
+    for prefix in ["PV_R", "PV_S", "PV_M", "PV_U"] + col_lv_spr:
+        pattern = re.compile(rf"^{prefix}_(\d{{4}})$")
+        found = {
+            int(match.group(1))
+            for match in map(pattern.match, pv_params.columns)
+            if match is not None
+        }
+        years = found if years is None else years & found
+    return sorted(years)
+
+
+def extract_wide_arrays(pv_params, years=None):
+    """
+    collects the wide `{var}_{year}` columns of `pv_params` into (municipality x year)
+    arrays. The result can be passed to `build_df_from_arrays` repeatedly to build
+    panels for any year range or row mask without going back to the dataframe.
+    `years` defaults to every year present in the data.
+    """
+    years = get_data_years(pv_params) if years is None else list(years)
+    arrays = {
+        "years": np.asarray(years),
+        "keys": {c: pv_params[c].to_numpy() for c in ftr_pref_muni},
+        "constant": {c: pv_params[c].to_numpy() for c in col_same_val},
+        "yearly": dict(),
+    }
+    for var in col_lv_spr + col_pv_cap:
+        cols = [f"{var}_{year}" for year in years]
+        arrays["yearly"][var] = pv_params[cols].to_numpy()
+    return arrays
+
+
+@profiled(rows=len)
+def build_df_from_arrays(arrays, years=None, mask=None, pv_totals=None):
+    """
+    builds the long panel from the output of `extract_wide_arrays`.
+    `years` selects a subset of the extracted years and `mask` is a boolean array over
+    the municipalities. The capacity shares are normalized over the masked rows only,
+    the same as calling `build_df_for_analysis` on the filtered `pv_params`.
+    `pv_totals` maps each `PV_*` column to its per-year totals (aligned with
+    `arrays["years"]`) to normalize by instead, e.g. when `arrays` is one chunk of a
+    larger table.
+    """
+    year_pos = np.arange(len(arrays["years"]))
+    if years is not None:
+        year_lookup = {year: i for i, year in enumerate(arrays["years"])}
+        year_pos = np.array([year_lookup[year] for year in years], dtype=int)
+    if mask is None:
+        rows = slice(None)
+    else:
+        rows = np.asarray(mask, dtype=bool)
 
-def build_df_for_analysis(pv_params, years=range(2014, 2024)):
-    df = []
+    n_years = len(year_pos)
+    data = dict()
+    data["year"] = np.repeat(
+        arrays["years"][year_pos], len(arrays["keys"]["pref"][rows])
+    )
 
     # these data do not change every year
-    ftr_pref_muni = ["pref", "muni"]
-    col_same_val = [
-        "demand",
-        "land_avail",
-        "taxable_income",
-        "pv_out",
-    ]
-    constant_df = pv_params[ftr_pref_muni + col_same_val]
+    for col, values in {**arrays["keys"], **arrays["constant"]}.items():
+        data[col] = np.tile(values[rows], n_years)
 
     # these data changes per year. The independent variables are the value the previous year.
-    for year in years:
-        # this year's capacity
-        col_yearly_y = [
-            f"PV_R_{year}",
-            f"PV_S_{year}",
-            f"PV_M_{year}",
-            f"PV_U_{year}",
-            f"PV_A_{year}",
-        ]
-        pv_cap_y = pv_params[col_yearly_y]
-        pv_cap_y = 100 * pv_cap_y / pv_cap_y.sum()
-        pv_cap_y.columns = ["PV_R", "PV_S", "PV_M", "PV_U", "PV_A"]
-
-        # land value and solar penetration rate
-        col_lv_spr = [f"LV_{year}", f"SPR_{year}"]
-        lv_spr_df = pv_params[col_lv_spr]
-        lv_spr_df.columns = ["LV", "SPR"]
-
-        df_temp = pd.concat([constant_df, lv_spr_df, pv_cap_y], axis=1)
-        df_temp.insert(0, "year", year)
-        df.append(df_temp)
-
-    df = pd.concat(df).reset_index(drop=True)
+    for col in col_lv_spr:
+        data[col] = arrays["yearly"][col][rows][:, year_pos].ravel(order="F")
 
-    return df
+    # capacity share of each municipality for the year
+    for col in col_pv_cap:
+        pv_cap_y = arrays["yearly"][col][rows][:, year_pos]
+        if pv_totals is None:
+            pv_total_y = np.nansum(pv_cap_y, axis=0)
+        else:
+            pv_total_y = np.asarray(pv_totals[col])[year_pos]
+        pv_cap_y = 100 * pv_cap_y / pv_total_y
+        data[col] = pv_cap_y.ravel(order="F")
+
+    return pd.DataFrame(data)
+
+
+@profiled(rows=len)
+def build_df_for_analysis(pv_params, years=None, mask=None):
+    arrays = extract_wide_arrays(pv_params, years)
+    return build_df_from_arrays(arrays, mask=mask)
+
+
+def extend_df_for_analysis(pv_params, df_prev, mask=None):
+    """
+    appends to `df_prev` the slices of the years present in `pv_params` but not yet in
+    `df_prev`. Each year is normalized on its own, so the result is the same as
+    rebuilding the whole panel. Returns the extended panel and the new years.
+    """
+    new_years = sorted(set(get_data_years(pv_params)) - set(df_prev["year"].unique()))
+    if not new_years:
+        return df_prev, new_years
+
+    df_new = build_df_for_analysis(pv_params, years=new_years, mask=mask)
+    df = pd.concat([df_prev, df_new[df_prev.columns]], ignore_index=True)
+    return df, new_years
 
 
 def csv_str_to_df(csv_str, header_row=None, index_col=None):
@@ -0,0 +1,202 @@
+"""
+Out-of-core version of `load_and_process_data` for parameter tables too large to hold
+in memory, e.g. grid cells instead of municipalities.
+
+The csv is read twice in chunks. The first pass accumulates the per-year totals of
+the `PV_*` columns that normalize the capacity shares; the second pass builds the
+long panel of each chunk with `build_df_from_arrays` and those totals. The panel is
+either yielded chunk by chunk (`iter_df_for_analysis`) or written to one feather file
+per year (`write_panel`) that is read back memory-mapped, one year at a time.
+"""
+
+import glob
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from utils.nbutils_load_data import (
+    build_df_from_arrays,
+    col_lv_spr,
+    col_pv_cap,
+    col_same_val,
+    extract_wide_arrays,
+    ftr_pref_muni,
+    get_data_years,
+    process_pv_params,
+)
+from utils.nbutils_profile import profiled
+
+pv_raw_types = ["PV_R", "PV_S", "PV_M", "PV_U"]
+col_land = ["land_habitable", "land_buildings", "land_agri"]
+
+panel_schema = pa.schema(
+    [("year", pa.int64())]
+    + [(c, pa.string()) for c in ftr_pref_muni]
+    + [(c, pa.float64()) for c in col_same_val + col_lv_spr + col_pv_cap]
+)
+
+
+def _csv_years(fileloc, years=None):
+    if years is not None:
+        return list(years)
+    return get_data_years(pd.read_csv(fileloc, nrows=0))
+
+
+def _keep_mask(chunk, exclude):
+    # rows whose (pref, muni) is not in `exclude`
+    if exclude is None:
+        return np.ones(len(chunk), dtype=bool)
+    return ~pd.MultiIndex.from_frame(chunk[ftr_pref_muni]).isin(exclude)
+
+
+def _exclude_index(exclude):
+    if exclude is None or isinstance(exclude, pd.MultiIndex):
+        return exclude
+    return pd.MultiIndex.from_frame(pd.DataFrame(exclude)[ftr_pref_muni])
+
+
+def iter_pv_params_chunks(fileloc, years=None, chunksize=100_000):
+    """
+    yields the csv in chunks of `chunksize` rows with the derived columns of
+    `process_pv_params`. Only the columns used by the analysis are read.
+    """
+    years = _csv_years(fileloc, years)
+    usecols = ftr_pref_muni + ["demand", "taxable_income", "pv_out"] + col_land
+    for var in pv_raw_types + col_lv_spr:
+        usecols += [f"{var}_{year}" for year in years]
+
+    reader = pd.read_csv(
+        fileloc,
+        usecols=usecols,
+        dtype={c: str for c in ftr_pref_muni},
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        yield process_pv_params(chunk)
+
+
+@profiled
+def accumulate_pv_totals(fileloc, years=None, chunksize=100_000, exclude=None):
+    """
+    first pass: the per-year totals of every `PV_*` column over the rows not in
+    `exclude` (a frame or MultiIndex of `pref`/`muni`), summed chunk by chunk.
+    Returns the years and a dict of column -> array of totals aligned with them.
+    """
+    years = _csv_years(fileloc, years)
+    exclude = _exclude_index(exclude)
+    usecols = ftr_pref_muni + [f"{t}_{year}" for t in pv_raw_types for year in years]
+
+    pv_totals = {col: np.zeros(len(years)) for col in col_pv_cap}
+    reader = pd.read_csv(
+        fileloc,
+        usecols=usecols,
+        dtype={c: str for c in ftr_pref_muni},
+        chunksize=chunksize,
+    )
+    for chunk in reader:
+        rows = _keep_mask(chunk, exclude)
+        pv_all = 0
+        for col in pv_raw_types:
+            pv_cap = chunk[[f"{col}_{year}" for year in years]].to_numpy()[rows]
+            pv_totals[col] += np.nansum(pv_cap, axis=0)
+            # same as `PV_A_{year}` of `process_pv_params`, where NaN counts as 0
+            pv_all = pv_all + np.nan_to_num(pv_cap)
+        pv_totals["PV_A"] += np.sum(pv_all, axis=0)
+    return years, pv_totals
+
+
+def iter_df_for_analysis(
+    fileloc, years=None, chunksize=100_000, exclude=None, pv_totals=None
+):
+    """
+    second pass: yields the long panel of `build_df_for_analysis` one chunk of the
+    csv at a time, each chunk ordered by year. The shares are normalized by
+    `pv_totals`, computed with `accumulate_pv_totals` when not given, so the chunks
+    together equal the panel built from the whole table (up to rounding of the sums).
+    """
+    exclude = _exclude_index(exclude)
+    if pv_totals is None:
+        years, pv_totals = accumulate_pv_totals(fileloc, years, chunksize, exclude)
+    years = _csv_years(fileloc, years)
+
+    for chunk in iter_pv_params_chunks(fileloc, years, chunksize):
+        arrays = extract_wide_arrays(chunk, years)
+        yield build_df_from_arrays(
+            arrays, mask=_keep_mask(chunk, exclude), pv_totals=pv_totals
+        )
+
+
+def panel_file(panel_dir, year):
+    return os.path.join(panel_dir, f"panel-{year}.feather")
+
+
+@profiled
+def write_panel(fileloc, panel_dir, years=None, chunksize=100_000, exclude=None):
+    """
+    streams the long panel into `panel_dir` as one feather file per year, never
+    holding more than one chunk of the csv in memory. Returns the years written.
+    """
+    years, pv_totals = accumulate_pv_totals(fileloc, years, chunksize, exclude)
+    os.makedirs(panel_dir, exist_ok=True)
+
+    writers = {
+        year: pa.ipc.new_file(panel_file(panel_dir, year) + ".tmp", panel_schema)
+        for year in years
+    }
+    try:
+        for df_chunk in iter_df_for_analysis(
+            fileloc, years, chunksize, exclude, pv_totals
+        ):
+            # each chunk is year-major with the same number of rows per year
+            n_rows = len(df_chunk) // len(years)
+            for i, year in enumerate(years):
+                df_year = df_chunk.iloc[i * n_rows : (i + 1) * n_rows]
+                writers[year].write_batch(
+                    pa.RecordBatch.from_arrays(
+                        [
+                            pa.array(
+                                df_year[c].to_numpy(), type=field.type, from_pandas=True
+                            )
+                            for c, field in zip(panel_schema.names, panel_schema)
+                        ],
+                        schema=panel_schema,
+                    )
+                )
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    for year in years:
+        os.replace(panel_file(panel_dir, year) + ".tmp", panel_file(panel_dir, year))
+    return years
+
+
+def panel_years(panel_dir):
+    """
+    years with a panel file in `panel_dir`.
+    """
+    pattern = re.compile(r"panel-(\d+)\.feather$")
+    matches = map(pattern.search, glob.glob(os.path.join(panel_dir, "panel-*.feather")))
+    return sorted(int(match.group(1)) for match in matches if match is not None)
+
+
+def read_panel_year(panel_dir, year, columns=None):
+    """
+    the rows of one year of a panel written by `write_panel`, memory-mapped.
+    """
+    table = feather.read_table(
+        panel_file(panel_dir, year), columns=columns, memory_map=True
+    )
+    return table.to_pandas()
+
+
+def iter_panel(panel_dir, years=None, columns=None):
+    """
+    yields `(year, df_year)` for the years of a panel written by `write_panel`.
+    """
+    for year in panel_years(panel_dir) if years is None else years:
+        yield year, read_panel_year(panel_dir, year, columns)
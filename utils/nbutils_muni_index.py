@@ -0,0 +1,79 @@
+import numpy as np
+import pandas as pd
+
+ftr_pref_muni = ["pref", "muni"]
+
+
+class MuniKeyIndex:
+    """
+    maps each (pref, muni) key to an integer code so that membership tests, joins and
+    cluster selection can run on integer arrays instead of tuples built row by row.
+
+    Keys listed in `japanadmincode.csv` get their municode. Any other key gets a code
+    above the largest municode, in the order it is first seen.
+    """
+
+    def __init__(self, admincode=None):
+        if admincode is None:
+            from utils.japan_admin_data import admincode_table
+
+            try:
+                admincode = admincode_table("all")
+            except FileNotFoundError:
+                admincode = None
+
+        if admincode is None:
+            self._keys = pd.MultiIndex.from_tuples([], names=ftr_pref_muni)
+            self._codes = np.empty(0, dtype=np.int64)
+        else:
+            self._keys = pd.MultiIndex.from_frame(admincode[ftr_pref_muni])
+            self._codes = admincode["municode"].to_numpy(dtype=np.int64)
+
+    def __len__(self):
+        return len(self._codes)
+
+    @staticmethod
+    def _as_keys(keys):
+        if isinstance(keys, pd.DataFrame):
+            return pd.MultiIndex.from_frame(keys[ftr_pref_muni])
+        if isinstance(keys, pd.MultiIndex):
+            return keys
+        return pd.MultiIndex.from_tuples(list(keys), names=ftr_pref_muni)
+
+    def _add(self, keys):
+        next_code = self._codes.max() + 1 if len(self._codes) else 0
+        new_codes = np.arange(next_code, next_code + len(keys), dtype=np.int64)
+        self._keys = self._keys.append(keys)
+        self._codes = np.concatenate([self._codes, new_codes])
+
+    def codes(self, keys):
+        """
+        integer codes of `keys`, given as a dataframe with `pref`/`muni` columns, a
+        (pref, muni) MultiIndex or a list of (pref, muni) tuples.
+        """
+        keys = self._as_keys(keys)
+        pos = self._keys.get_indexer(keys)
+        missing = pos == -1
+        if missing.any():
+            self._add(keys[missing].unique())
+            pos = self._keys.get_indexer(keys)
+        return self._codes[pos]
+
+    def isin(self, df, keys):
+        """
+        boolean mask of the rows of `df` whose (pref, muni) is in `keys`.
+        """
+        return np.isin(self.codes(df), self.codes(keys))
+
+
+_muni_key_index = None
+
+
+def get_muni_key_index():
+    """
+    the shared `MuniKeyIndex`, created on first use.
+    """
+    global _muni_key_index
+    if _muni_key_index is None:
+        _muni_key_index = MuniKeyIndex()
+    return _muni_key_index
@@ -0,0 +1,125 @@
+"""
+The signed outlier flags of `get_pred_n_outliers_batch` as a dense int8 array of
+(municipality x year x PV type), and the selections of notebook 02 as reductions of
+it: the outlier counts per municipality, the municipalities with at least one
+outlier and those beyond the extreme limits.
+
+The panels without the selected municipalities are built from the wide arrays of
+`extract_wide_arrays` with a row mask, which normalizes the capacity shares over the
+remaining municipalities as rebuilding the panel from the filtered table does.
+"""
+
+import numpy as np
+import pandas as pd
+
+from utils.nbutils_load_data import build_df_from_arrays, extract_wide_arrays
+from utils.nbutils_profile import profiled
+
+ftr_pref_muni = ["pref", "muni"]
+
+
+class OutlierCube:
+    """
+    `flags[m, y, t]` is -1, 0 or 1 for the municipality `keys.iloc[m]` in
+    `years[y]` and the PV type `pv_types[t]`. Municipalities without a flag for a
+    year (e.g. not in the tagged panel) count as 0.
+    """
+
+    def __init__(self, flags, keys, years, pv_types):
+        self.flags = flags
+        self.keys = keys.reset_index(drop=True)
+        self.years = list(years)
+        self.pv_types = list(pv_types)
+
+    @classmethod
+    def from_outliers(cls, df_outliers, keys, pv_types, years=None):
+        """
+        the cube of `df_outliers` (the output of `get_pred_n_outliers_batch`) with the
+        municipalities in the order of `keys`, a frame with `pref`/`muni` such as
+        `pv_params`.
+        """
+        if years is None:
+            years = sorted(df_outliers["year"].unique())
+        keys = keys[ftr_pref_muni].reset_index(drop=True)
+        muni_pos = pd.MultiIndex.from_frame(keys).get_indexer(
+            pd.MultiIndex.from_frame(df_outliers[ftr_pref_muni])
+        )
+        year_pos = pd.Categorical(df_outliers["year"], categories=years).codes
+        rows = (muni_pos != -1) & (year_pos != -1)
+
+        flags = np.zeros((len(keys), len(years), len(pv_types)), dtype=np.int8)
+        for t, pv_type in enumerate(pv_types):
+            values = df_outliers[pv_type].to_numpy()[rows]
+            flags[muni_pos[rows], year_pos[rows], t] = values.astype(np.int8)
+        return cls(flags, keys, years, pv_types)
+
+    def counts(self):
+        """
+        (municipality x PV type) sum of the signed flags over the years.
+        """
+        return self.flags.sum(axis=1, dtype=np.int64)
+
+    def at_least_one(self):
+        """
+        municipalities with outliers, as in notebook 02: the signed counts summed over
+        the PV types are not 0.
+        """
+        return self.counts().sum(axis=1) != 0
+
+    def extremes(self, outlier_limits):
+        """
+        municipalities with outliers whose count of any PV type is outside its
+        `outlier_limits[pv_type]` = (low, high), both limits included in the range.
+        """
+        counts = self.counts()
+        low = np.array([outlier_limits[t][0] for t in self.pv_types])
+        high = np.array([outlier_limits[t][1] for t in self.pv_types])
+        beyond = ((counts < low) | (counts > high)).any(axis=1)
+        return self.at_least_one() & beyond
+
+    def counts_frame(self, mask=None):
+        """
+        the counts of the municipalities in `mask` (all by default) indexed by
+        (pref, muni) in sorted order, the `df_outlier_a1` table of notebook 02.
+        """
+        counts = pd.DataFrame(
+            self.counts(),
+            index=pd.MultiIndex.from_frame(self.keys),
+            columns=self.pv_types,
+        )
+        if mask is not None:
+            counts = counts[mask]
+        return counts.sort_index()
+
+    def consolidated(self):
+        """
+        the flags as a long frame with `year`, `pref`, `muni` and one column per PV
+        type, the `df_outliers_consol` table of notebook 02.
+        """
+        n_muni, n_years, _ = self.flags.shape
+        df = pd.DataFrame(
+            {
+                "year": np.repeat(self.years, n_muni),
+                "pref": np.tile(self.keys["pref"].to_numpy(), n_years),
+                "muni": np.tile(self.keys["muni"].to_numpy(), n_years),
+            }
+        )
+        for t, pv_type in enumerate(self.pv_types):
+            df[pv_type] = self.flags[:, :, t].ravel(order="F")
+        return df
+
+
+@profiled
+def filtered_panels(pv_params, masks, arrays=None, years=None):
+    """
+    long panels without the municipalities of each mask in `masks` (a dict of name ->
+    boolean array aligned with `pv_params`, e.g. `at_least_one()` and `extremes()`
+    of an `OutlierCube` built with `keys=pv_params`). The wide arrays are extracted
+    once, or passed as `arrays`. Returns a dict of name -> panel.
+    """
+    if arrays is None:
+        arrays = extract_wide_arrays(pv_params, years)
+    return {
+        name: build_df_from_arrays(arrays, years=years, mask=~np.asarray(mask))
+        for name, mask in masks.items()
+    }
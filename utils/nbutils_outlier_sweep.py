@@ -0,0 +1,140 @@
+"""
+Choice of the outlier threshold of notebook 02 over a grid instead of one notebook run
+per threshold.
+
+The yearly models predict every (PV type, year) once and the residuals, z-scores and
+per-year standard deviations are kept. Each threshold multiplier is then a comparison
+against them, giving an `OutlierCube`; each pair of (threshold, limit) selects the
+municipalities to exclude: those with at least one outlier (`limit=None`) or beyond
+the extreme limits (-limit, limit) for every PV type. The models without each
+selection are retrained in parallel, once per distinct selection.
+"""
+
+import numpy as np
+import pandas as pd
+
+from utils.nbutils_load_data import extract_wide_arrays
+from utils.nbutils_outlier_cube import OutlierCube, filtered_panels
+from utils.nbutils_profile import profiled
+from utils.nbutils_regression import (
+    predict_residuals,
+    regression_analysis_yearly_parallel,
+    tag_outliers,
+)
+
+
+def _limit_value(limit):
+    # at least one outlier is reported as a NaN limit so that the column is numeric
+    return np.nan if limit is None else limit
+
+
+class OutlierSweep:
+    """
+    the residuals of `models[var_dv][year]` (see `predict_residuals`) on the panel
+    `df` built from `pv_params`, and the outlier selections for any threshold.
+    """
+
+    def __init__(
+        self, df, pv_params, vars_dv, vars_iv, models, years=None, method="z_score"
+    ):
+        self.pv_params = pv_params
+        self.vars_dv = list(vars_dv)
+        self.vars_iv = list(vars_iv)
+        self.method = method
+        self.residuals = predict_residuals(df, vars_dv, vars_iv, models, years)
+        self.years = sorted(self.residuals["year"].unique())
+        self._arrays = None
+
+    def cube(self, threshold_multiplier):
+        """
+        the `OutlierCube` of one threshold multiplier, without predicting again.
+        """
+        df_outliers = self.residuals[["year", "pref", "muni"]].copy()
+        for var_dv in self.vars_dv:
+            df_outliers[var_dv] = tag_outliers(
+                self.residuals, var_dv, threshold_multiplier, self.method
+            )
+        return OutlierCube.from_outliers(
+            df_outliers, self.pv_params, self.vars_dv, self.years
+        )
+
+    def masks(self, thresholds, limits=(None,)):
+        """
+        municipalities to exclude for every (threshold multiplier, limit), a dict of
+        (threshold, limit) -> boolean array aligned with `pv_params`.
+        """
+        masks = dict()
+        for threshold in thresholds:
+            cube = self.cube(threshold)
+            for limit in limits:
+                if limit is None:
+                    masks[(threshold, limit)] = cube.at_least_one()
+                else:
+                    outlier_limits = {v: (-limit, limit) for v in self.vars_dv}
+                    masks[(threshold, limit)] = cube.extremes(outlier_limits)
+        return masks
+
+    @profiled
+    def summary(self, thresholds, limits=(None,)):
+        """
+        per (threshold, limit): the number of outlier (municipality, year) pairs of
+        each PV type and the number of municipalities excluded.
+        """
+        rows = []
+        for threshold in thresholds:
+            cube = self.cube(threshold)
+            n_flags = np.abs(cube.flags).sum(axis=(0, 1))
+            for limit in limits:
+                if limit is None:
+                    excluded = cube.at_least_one()
+                else:
+                    excluded = cube.extremes({v: (-limit, limit) for v in self.vars_dv})
+                row = {"threshold": threshold, "limit": _limit_value(limit)}
+                row.update({f"{v}_n_flags": n for v, n in zip(self.vars_dv, n_flags)})
+                row["n_excluded"] = int(excluded.sum())
+                rows.append(row)
+        return pd.DataFrame(rows)
+
+    @profiled
+    def retrain(self, model, thresholds, limits=(None,), n_jobs=-1, **kwargs):
+        """
+        retrains `model` year by year without the municipalities of every
+        (threshold, limit), all (selection, PV type, year) fits in parallel with
+        `regression_analysis_yearly_parallel`. Selections that exclude the same
+        municipalities are fitted once. Returns one row per (threshold, limit, PV
+        type, year) with the number of municipalities excluded and the metrics.
+        """
+        if self._arrays is None:
+            self._arrays = extract_wide_arrays(self.pv_params, self.years)
+
+        masks = self.masks(thresholds, limits)
+        selections = dict()
+        for key, mask in masks.items():
+            selections.setdefault(mask.tobytes(), (mask, []))[1].append(key)
+        names = {data: f"selection_{i}" for i, data in enumerate(selections)}
+
+        panels = filtered_panels(
+            self.pv_params,
+            {names[data]: mask for data, (mask, _) in selections.items()},
+            arrays=self._arrays,
+        )
+        results, _, _ = regression_analysis_yearly_parallel(
+            panels, self.vars_iv, self.vars_dv, model, n_jobs=n_jobs, **kwargs
+        )
+
+        tables = []
+        for data, (mask, keys) in selections.items():
+            for var_dv in self.vars_dv:
+                for threshold, limit in keys:
+                    df_r = results[names[data]][var_dv][["year", "r2", "mae", "rmse"]]
+                    df_r = df_r.copy()
+                    df_r.insert(0, "n_excluded", int(mask.sum()))
+                    df_r.insert(0, "var_dv", var_dv)
+                    df_r.insert(0, "limit", _limit_value(limit))
+                    df_r.insert(0, "threshold", threshold)
+                    tables.append(df_r)
+        return (
+            pd.concat(tables, ignore_index=True)
+            .sort_values(["threshold", "limit", "var_dv", "year"], na_position="first")
+            .reset_index(drop=True)
+        )
@@ -0,0 +1,172 @@
+import pandas as pd
+
+from utils.japan_admin_data import prefecture_dict_jp_to_en, muni_en_map
+from utils.nbutils_cluster_stats import get_pref_muni_isin, apply_scale
+from utils.nbutils_shap import compute_shap_values
+
+
+# outlier utils
+def is_float_between(value, range_tuple):
+    lower_bound, upper_bound = range_tuple
+    return lower_bound < value < upper_bound
+
+
+def get_closest_cluster(value, cluster_pv_range):
+    vals = []
+    for k, values in cluster_pv_range.items():
+        for v in values:
+            vals.append([v, k])
+    vals = (
+        pd.DataFrame(vals, columns=["values", "cluster"])
+        .sort_values("values")
+        .reset_index(drop=True)
+    )
+    if value > vals["values"].max():
+        return "-"
+    vals["residue"] = abs(vals["values"] - value)
+    return int(vals.sort_values("residue").iloc[0]["cluster"])
+
+
+def get_potential_cluster(value, cluster_pv_range):
+    potential_list = []
+    for cluster, pv_range in cluster_pv_range.items():
+        if is_float_between(value, pv_range):
+            potential_list.append(str(cluster))
+    if len(potential_list) == 0:
+        return get_closest_cluster(value, cluster_pv_range)
+    return ",".join(potential_list)
+
+
+def get_cluster_pv_range(df, cluster_index, scale_param, vars_dv):
+    pv_range_val = dict()
+    scale_dict = scale_param["scaler"].to_dict()
+
+    for cluster_no, cluster_indx in cluster_index.items():
+        df_temp = get_pref_muni_isin(df, cluster_indx)
+        df_temp = apply_scale(df_temp, scale_dict)
+        df_temp = df_temp[scale_dict.keys()]
+        pv_range_val[cluster_no] = (
+            float(df_temp[vars_dv].min().round(4)),
+            float(df_temp[vars_dv].max().round(4)),
+        )
+    return pv_range_val
+
+
+def score_outliers(
+    pv_param_outliers,
+    pv_param_no_outliers,
+    vars_dv,
+    vars_iv,
+    model_rfr,
+    model_rfc,
+    cluster_pv_range,
+    scale_param,
+    year=2023,
+):
+    """
+    compares the actual capacity share of the outlier municipalities with the SHAP
+    explanation of the pooled RFR (`inc_ratio`), and with the cluster predicted by the
+    RFC (`cluster_p`) and the cluster whose range holds the actual value (`cluster_a`).
+    """
+    ftr_pref_muni = ["pref", "muni"]
+    var_dv_year = f"{vars_dv}_{year}"
+    cols = ftr_pref_muni + [
+        "demand",
+        "land_avail",
+        "taxable_income",
+        f"LV_{year}",
+        f"SPR_{year}",
+        "pv_out",
+        var_dv_year,
+    ]
+    df_outliers = pv_param_outliers[cols].copy()
+    rename_cols = {
+        c: c.replace(f"_{year}", "")
+        for c in df_outliers.filter(regex=f"{year}$").columns
+    }
+    df_outliers = df_outliers.rename(columns=rename_cols)
+    df_outliers[vars_dv] = (
+        100 * df_outliers[vars_dv] / pv_param_no_outliers[var_dv_year].sum()
+    )
+
+    shap_values, expected_value = compute_shap_values(model_rfr, df_outliers[vars_iv])
+    shap_values_outliers_df = pd.DataFrame(shap_values, columns=vars_iv)
+    shap_values_outliers_df.columns = [
+        f"{c}_score" for c in shap_values_outliers_df.columns
+    ]
+    shap_values_outliers_df[f"{vars_dv}_shap"] = (
+        shap_values_outliers_df.sum(axis=1) + expected_value
+    )
+    shap_values_outliers_df = pd.concat(
+        [df_outliers.reset_index(drop=True), shap_values_outliers_df], axis=1
+    )
+    shap_values_outliers_df["inc_ratio"] = (
+        shap_values_outliers_df[vars_dv] / shap_values_outliers_df[f"{vars_dv}_shap"]
+    )
+    shap_values_outliers_df["pref_en"] = shap_values_outliers_df["pref"].map(
+        prefecture_dict_jp_to_en
+    )
+    shap_values_outliers_df["muni_en"] = shap_values_outliers_df["muni"].map(
+        muni_en_map()
+    )
+
+    # using the parameters of the city, the model predicts what cluster it should be.
+    shap_values_outliers_df["cluster_p"] = model_rfc.predict(
+        shap_values_outliers_df[vars_iv]
+    )
+    selected_outliers = shap_values_outliers_df.sort_values(
+        "inc_ratio", ascending=False
+    ).reset_index(drop=True)
+
+    # uses the actual value and the cluster ranges and assigns where the actual value should fall
+    selected_outliers["cluster_a"] = selected_outliers[vars_dv].apply(
+        get_potential_cluster, args=(cluster_pv_range,)
+    )
+
+    scale_dict = scale_param["scaler"].to_dict()
+    return apply_scale(selected_outliers, scale_dict)
+
+
+def select_proactive(selected_outliers, inc_ratio_min):
+    """
+    municipalities whose `inc_ratio` is above `inc_ratio_min[vars_dv]` for any PV type,
+    with the score columns of every PV type side by side and the English names of
+    notebook 04.
+    """
+    ftr_pref_muni = ["pref", "muni"]
+    proactive_index = (
+        pd.concat(
+            [
+                df_temp[df_temp["inc_ratio"] > inc_ratio_min[vars_dv]][ftr_pref_muni]
+                for vars_dv, df_temp in selected_outliers.items()
+            ]
+        )
+        .drop_duplicates()
+        .reset_index(drop=True)
+    )
+    proactive_index = pd.MultiIndex.from_frame(proactive_index)
+
+    so_stats = []
+    for vars_dv, df_temp in selected_outliers.items():
+        cols = [vars_dv, f"{vars_dv}_shap", "inc_ratio", "cluster_p", "cluster_a"]
+        df_temp = df_temp.set_index(ftr_pref_muni)
+        df_temp = df_temp[df_temp.index.isin(proactive_index)][cols].rename(
+            columns={
+                "inc_ratio": f"{vars_dv}_ir",
+                "cluster_a": f"{vars_dv}_cluster_a",
+                "cluster_p": f"{vars_dv}_cluster_p",
+            }
+        )
+        so_stats.append(df_temp)
+
+    so_stats = pd.concat(so_stats, axis=1).reset_index()
+    so_stats.insert(2, "muni_en", so_stats["muni"].map(muni_en_map()))
+    so_stats.insert(2, "pref_en", so_stats["pref"].map(prefecture_dict_jp_to_en))
+    # without the municipality suffixes, as displayed in notebook 04
+    so_stats["muni_en"] = (
+        so_stats["muni_en"]
+        .str.replace("-shi", "", regex=False)
+        .str.replace("-machi", "", regex=False)
+    )
+    ir_cols = [f"{vars_dv}_ir" for vars_dv in reversed(list(selected_outliers))]
+    return so_stats.sort_values(ir_cols, ascending=False).reset_index(drop=True)
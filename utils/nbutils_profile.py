@@ -0,0 +1,292 @@
+"""
+Light-weight profiling of the utils functions.
+
+Functions decorated with `profiled` and blocks wrapped in `span` report their wall
+time, CPU time, peak memory (tracemalloc) and row count, nested by call. Profiling
+is off unless the environment variable `PV_GROWTH_PROFILE` is set to a true value
+("1", "true", ...) or `config.json` has `"profile": "True"`, or `enable_profiling()`
+is called. When off, a decorated call costs one flag check.
+
+The records are available as a flat table (`profile_table`, `profile_summary`) and
+as a Chrome trace (`export_chrome_trace`, viewable in chrome://tracing or Perfetto).
+With `PV_GROWTH_PROFILE_TRACE` set to a path, the trace is also written at exit;
+`{pid}` in the path is replaced by the process id. Spans are only recorded in the
+process that runs them, not in joblib or pool workers.
+"""
+
+import atexit
+import functools
+import inspect
+import itertools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+_true_values = ("1", "true", "yes", "on")
+
+_state = {"enabled": False}
+_records = []
+_local = threading.local()
+_lock = threading.Lock()
+_ids = itertools.count()
+_t0 = time.perf_counter_ns()
+
+
+def _is_true(value):
+    return str(value).strip().lower() in _true_values
+
+
+def _config_value(key):
+    config_fn = os.path.join(os.path.dirname(os.path.dirname(__file__)), "config.json")
+    if not os.path.exists(config_fn):
+        return None
+    with open(config_fn) as config_file:
+        return json.load(config_file).get(key)
+
+
+def enable_profiling(trace_memory=True):
+    """
+    starts recording. `trace_memory` turns on tracemalloc for the peak memory, which
+    slows allocation-heavy code noticeably.
+    """
+    _state["enabled"] = True
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable_profiling():
+    _state["enabled"] = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def is_profiling():
+    return _state["enabled"]
+
+
+def reset_profile():
+    with _lock:
+        _records.clear()
+
+
+# ============================================================================ #
+# Spans
+# ============================================================================ #
+class _NullSpan:
+    """
+    span used while profiling is off: a no-op context manager.
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _fold_peak(stack):
+    # the tracemalloc peak is global, so it is read and reset at every span boundary
+    # and folded into every open span.
+    if not tracemalloc.is_tracing():
+        return None
+    current, peak = tracemalloc.get_traced_memory()
+    for open_span in stack:
+        open_span.peak = max(open_span.peak, peak)
+    tracemalloc.reset_peak()
+    return current
+
+
+class _Span:
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        stack = _stack()
+        self.parent = stack[-1].id if stack else None
+        self.depth = len(stack)
+        self.id = next(_ids)
+        self.mem_start = _fold_peak(stack) or 0
+        self.peak = self.mem_start
+        stack.append(self)
+        self.start = time.perf_counter_ns()
+        self.cpu_start = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        cpu = time.process_time() - self.cpu_start
+        stack = _stack()
+        _fold_peak(stack)
+        stack.pop()
+        peak = self.peak - self.mem_start if tracemalloc.is_tracing() else None
+
+        with _lock:
+            _records.append(
+                {
+                    "name": self.name,
+                    "id": self.id,
+                    "parent": self.parent,
+                    "depth": self.depth,
+                    "start_s": (self.start - _t0) / 1e9,
+                    "wall_s": (end - self.start) / 1e9,
+                    "cpu_s": cpu,
+                    "peak_mb": None if peak is None else peak / 2**20,
+                    "rows": self.rows,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "error": exc[0].__name__ if exc[0] is not None else None,
+                }
+            )
+        return False
+
+
+def span(name, rows=None):
+    """
+    context manager recording the enclosed block as `name`. The row count can be set
+    on the returned object, e.g. `with span("fit") as s: ...; s.rows = len(X)`.
+    """
+    if not _state["enabled"]:
+        return _null_span
+    return _Span(name, rows)
+
+
+def _count_rows(obj):
+    if isinstance(obj, tuple):
+        obj = obj[0]
+    try:
+        return len(obj)
+    except TypeError:
+        return None
+
+
+def profiled(func=None, name=None, rows=None):
+    """
+    decorator recording every call of the function as a span named after it.
+    `rows` is a callable applied to the return value, or the name of an argument
+    whose length is the row count.
+    """
+    if func is None:
+        return functools.partial(profiled, name=name, rows=rows)
+
+    span_name = name or f"{func.__module__.split('.')[-1]}.{func.__qualname__}"
+    signature = inspect.signature(func) if isinstance(rows, str) else None
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _state["enabled"]:
+            return func(*args, **kwargs)
+
+        with _Span(span_name) as s:
+            if signature is not None:
+                s.rows = _count_rows(
+                    signature.bind_partial(*args, **kwargs).arguments.get(rows)
+                )
+            result = func(*args, **kwargs)
+            if callable(rows):
+                s.rows = rows(result)
+        return result
+
+    return wrapper
+
+
+# ============================================================================ #
+# Exports
+# ============================================================================ #
+def profile_table():
+    """
+    one row per recorded call, in order of completion.
+    """
+    with _lock:
+        return pd.DataFrame(
+            list(_records),
+            columns=[
+                "name",
+                "id",
+                "parent",
+                "depth",
+                "start_s",
+                "wall_s",
+                "cpu_s",
+                "peak_mb",
+                "rows",
+                "pid",
+                "tid",
+                "error",
+            ],
+        )
+
+
+def profile_summary():
+    """
+    calls, total and mean wall time, total CPU time, largest peak memory and total rows
+    per span name, slowest first.
+    """
+    df = profile_table()
+    summary = df.groupby("name").agg(
+        calls=("wall_s", "size"),
+        wall_s=("wall_s", "sum"),
+        wall_mean_s=("wall_s", "mean"),
+        cpu_s=("cpu_s", "sum"),
+        peak_mb=("peak_mb", "max"),
+        rows=("rows", "sum"),
+    )
+    return summary.sort_values("wall_s", ascending=False)
+
+
+def export_chrome_trace(fn):
+    """
+    writes the records as complete ("X") events of the Chrome trace event format.
+    """
+    events = []
+    for record in profile_table().to_dict("records"):
+        args = {
+            k: record[k]
+            for k in ["cpu_s", "peak_mb", "rows", "error"]
+            if not pd.isna(record[k])
+        }
+        events.append(
+            {
+                "name": record["name"],
+                "ph": "X",
+                "ts": record["start_s"] * 1e6,
+                "dur": record["wall_s"] * 1e6,
+                "pid": record["pid"],
+                "tid": record["tid"],
+                "args": args,
+            }
+        )
+    with open(fn, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def _export_at_exit(fn):
+    if _records:
+        export_chrome_trace(fn.replace("{pid}", str(os.getpid())))
+
+
+if _is_true(os.environ.get("PV_GROWTH_PROFILE", "")) or _is_true(
+    _config_value("profile")
+):
+    enable_profiling()
+    if os.environ.get("PV_GROWTH_PROFILE_TRACE"):
+        atexit.register(_export_at_exit, os.environ["PV_GROWTH_PROFILE_TRACE"])
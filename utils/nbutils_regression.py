@@ -1,27 +1,47 @@
+import copy
+
 import pandas as pd
 import numpy as np
 
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.base import clone
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import r2_score, mean_absolute_error, mean_squared_error
 
+from utils.nbutils_estimators import native_importances
+from utils.nbutils_profile import profiled
+
 
-def scale_data(df, vars_iv=None, var_dv=None, iv_scaler=None, dv_scaler=None):
+def scale_data(df, vars_iv=None, var_dv=None, iv_scaler=None, dv_scaler=None, fit=True):
     """
-    scales the corresponding variables if scaler is provided.
+    scales the corresponding variables if scaler is provided. With `fit=False` the
+    scalers are already fitted and only transform. For the whole panel at once, see
+    `nbutils_scaling.scale_panel`.
     """
     if vars_iv and iv_scaler:
         # Standardize the independent variables
-        df[vars_iv] = iv_scaler.fit_transform(df[vars_iv])
+        if fit:
+            df[vars_iv] = iv_scaler.fit_transform(df[vars_iv])
+        else:
+            df[vars_iv] = iv_scaler.transform(df[vars_iv])
     if var_dv and dv_scaler:
         # Standardize the dependent variable
-        df[var_dv] = dv_scaler.fit_transform(df[[var_dv]])
+        if fit:
+            df[var_dv] = dv_scaler.fit_transform(df[[var_dv]])
+        else:
+            df[var_dv] = dv_scaler.transform(df[[var_dv]])
     return df, iv_scaler, dv_scaler
 
 
+@profiled(rows="X")
 def train_and_evaluate(X, y, model, **kwargs):
     X_train, X_test, y_train, y_test = train_test_split(
         X, y, test_size=0.2, random_state=42
     )
+    return fit_and_score(X_train, X_test, y_train, y_test, model, **kwargs)
+
+
+def fit_and_score(X_train, X_test, y_train, y_test, model, **kwargs):
     model.fit(X_train, y_train, **kwargs)
     y_pred = model.predict(X_test)
     r2 = r2_score(y_test, y_pred)
@@ -41,33 +61,45 @@ def regression_analysis(
     X = df_temp[vars_iv]
     y = df_temp[var_dv]
     trained_model, r2, mae, mse, rmse = train_and_evaluate(X, y, model, **kwargs)
+    keys, stats = get_model_stats(trained_model, vars_iv, [r2, mae, mse, rmse])
+    return keys, stats, trained_model, dv_scaler
 
-    if hasattr(trained_model, "feature_importances_"):
-        importances = list(trained_model.feature_importances_)
-        stats = [r2, mae, mse, rmse] + importances
-        keys = ["r2", "mae", "mse", "rmse"] + vars_iv
-    elif hasattr(trained_model, "coef_"):
-        importances = list(trained_model.coef_)
-        stats = [r2, mae, mse, rmse] + importances
-        keys = ["r2", "mae", "mse", "rmse"] + vars_iv
-    else:
-        stats = [r2, mae, mse, rmse]
-        keys = ["r2", "mae", "mse", "rmse"]
 
-    return keys, stats, trained_model, dv_scaler
+def get_model_stats(trained_model, vars_iv, metrics):
+    """
+    names and values of the metrics followed by the importances or coefficients of
+    `trained_model` (see `native_importances`), the columns of the results of
+    `regression_analysis_yearly`.
+    """
+    importances = native_importances(trained_model)
+    keys = ["r2", "mae", "mse", "rmse"]
+    if importances is None:
+        return keys, list(metrics)
+    return keys + vars_iv, list(metrics) + list(importances)
 
 
+@profiled(rows="df")
 def regression_analysis_yearly(
-    df, vars_iv, var_dv, model, iv_scaler=None, dv_scaler=None, **kwargs
+    df, vars_iv, var_dv, model, iv_scaler=None, dv_scaler=None, years=None, **kwargs
 ):
     logs = []
     trained_models = dict()
     dv_scalers = dict()
 
-    for year in range(2014, 2024):
+    if years is None:
+        years = sorted(df["year"].unique())
+
+    for year in years:
         df_y = df[df["year"] == year].copy()
+        # every year keeps its own fitted scaler; the model is shared as before
         keys, stats, trained_models[year], dv_scalers[year] = regression_analysis(
-            df_y, vars_iv, var_dv, model, iv_scaler, dv_scaler, **kwargs
+            df_y,
+            vars_iv,
+            var_dv,
+            model,
+            None if iv_scaler is None else clone(iv_scaler),
+            None if dv_scaler is None else clone(dv_scaler),
+            **kwargs,
         )
         # trained_models[year] = trained_model
         logs.append([year] + stats)
@@ -77,12 +109,297 @@ def regression_analysis_yearly(
     return results, trained_models, dv_scalers
 
 
+def regression_analysis_yearly_update(
+    df,
+    vars_iv,
+    var_dv,
+    model,
+    results,
+    trained_models,
+    dv_scalers,
+    iv_scaler=None,
+    dv_scaler=None,
+    **kwargs,
+):
+    """
+    extends the output of `regression_analysis_yearly` with the years of `df` that it
+    does not have yet, e.g. after `extend_df_for_analysis` appended a new year. Only the
+    new years are trained, on clones of `model` and the scalers so that the models of
+    the earlier years are left untouched. The outliers of the new years follow from
+    `get_pred_n_outliers_batch(..., years=new_years)`.
+    Returns the updated `(results, trained_models, dv_scalers)` and the new years.
+    """
+    new_years = sorted(set(df["year"].unique()) - set(results["year"]))
+    if not new_years:
+        return results, trained_models, dv_scalers, new_years
+
+    new_results, new_models, new_dv_scalers = regression_analysis_yearly(
+        df,
+        vars_iv,
+        var_dv,
+        clone(model),
+        None if iv_scaler is None else clone(iv_scaler),
+        None if dv_scaler is None else clone(dv_scaler),
+        years=new_years,
+        **kwargs,
+    )
+    results = pd.concat([results, new_results], ignore_index=True)
+    trained_models = {**trained_models, **new_models}
+    dv_scalers = {**dv_scalers, **new_dv_scalers}
+    return results, trained_models, dv_scalers, new_years
+
+
+@profiled
+def regression_analysis_yearly_panel(
+    panel_dir,
+    vars_iv,
+    var_dv,
+    model,
+    iv_scaler=None,
+    dv_scaler=None,
+    years=None,
+    **kwargs,
+):
+    """
+    `regression_analysis_yearly` on a panel written by `write_panel`, reading one year
+    and only the needed columns at a time. Each year is trained on clones of `model`
+    and the scalers.
+    """
+    from utils.nbutils_load_stream import iter_panel
+
+    logs = []
+    trained_models = dict()
+    dv_scalers = dict()
+
+    columns = ["year"] + list(vars_iv) + [var_dv]
+    for year, df_y in iter_panel(panel_dir, years, columns):
+        keys, stats, trained_models[year], dv_scalers[year] = regression_analysis(
+            df_y,
+            vars_iv,
+            var_dv,
+            clone(model),
+            None if iv_scaler is None else clone(iv_scaler),
+            None if dv_scaler is None else clone(dv_scaler),
+            **kwargs,
+        )
+        logs.append([year] + stats)
+
+    results = pd.DataFrame(logs, columns=["year"] + keys)
+    return results, trained_models, dv_scalers
+
+
+def _forest_snapshot(model, n_estimators):
+    # the fitted ensemble restricted to its first `n_estimators` members, sharing them
+    snapshot = copy.copy(model)
+    snapshot.estimators_ = model.estimators_[:n_estimators]
+    snapshot.n_estimators = n_estimators
+    return snapshot
+
+
+@profiled(rows="df")
+def regression_analysis_panel(
+    df,
+    vars_iv,
+    var_dv,
+    model,
+    mode="pooled",
+    iv_scaler=None,
+    dv_scaler=None,
+    years=None,
+    trees_per_year=None,
+    test_size=0.2,
+    random_state=42,
+    **kwargs,
+):
+    """
+    trains one model for all `years` instead of one per year, with the same results
+    table as `regression_analysis_yearly`.
+
+    Each year is scaled and split into train and test rows exactly as in
+    `regression_analysis_yearly`, and the metrics of a year are computed on its test
+    rows, so both tables can be compared row by row.
+
+    mode="pooled": one fit of `model` on the training rows of all years with `year`
+    as an extra feature; its importance is the `year_importance` column.
+    mode="incremental": `model` (an ensemble with `warm_start`, e.g. a random forest)
+    grows `trees_per_year` new estimators on each year's training rows, in year
+    order, on top of those of the earlier years. By default the `n_estimators` of
+    `model` are spread over the years. The model of a year holds the estimators
+    grown up to that year.
+
+    Returns `(results, trained_models, dv_scalers)` as `regression_analysis_yearly`;
+    in pooled mode every year maps to the same model.
+    """
+    if mode not in ["pooled", "incremental"]:
+        raise ValueError(f"unknown training mode: {mode}")
+    if years is None:
+        years = sorted(df["year"].unique())
+    model = clone(model)
+    if mode == "incremental":
+        params = model.get_params()
+        if "warm_start" not in params or "n_estimators" not in params:
+            raise ValueError("incremental training needs an ensemble with warm_start")
+        if trees_per_year is None:
+            trees_per_year = max(1, params["n_estimators"] // len(years))
+
+    splits = dict()
+    dv_scalers = dict()
+    for year in years:
+        df_y, _, dv_scalers[year] = scale_data(
+            df[df["year"] == year].copy(),
+            vars_iv,
+            var_dv,
+            None if iv_scaler is None else clone(iv_scaler),
+            None if dv_scaler is None else clone(dv_scaler),
+        )
+        X = df_y[vars_iv]
+        if mode == "pooled":
+            X = X.assign(year=year)
+        splits[year] = train_test_split(
+            X, df_y[var_dv], test_size=test_size, random_state=random_state
+        )
+
+    trained_models = dict()
+    if mode == "pooled":
+        model.fit(
+            pd.concat([splits[year][0] for year in years]),
+            pd.concat([splits[year][2] for year in years]),
+            **kwargs,
+        )
+        trained_models = {year: model for year in years}
+    else:
+        model.set_params(warm_start=True, n_estimators=0)
+        for year in years:
+            X_train, _, y_train, _ = splits[year]
+            n_estimators = model.n_estimators + trees_per_year
+            model.set_params(n_estimators=n_estimators)
+            model.fit(X_train, y_train, **kwargs)
+            trained_models[year] = _forest_snapshot(model, n_estimators)
+
+    logs = []
+    for year in years:
+        _, X_test, _, y_test = splits[year]
+        y_pred = trained_models[year].predict(X_test)
+        mse = mean_squared_error(y_test, y_pred)
+        metrics = [
+            r2_score(y_test, y_pred),
+            mean_absolute_error(y_test, y_pred),
+            mse,
+            np.sqrt(mse),
+        ]
+        features = vars_iv + ["year"] if mode == "pooled" else vars_iv
+        keys, stats = get_model_stats(trained_models[year], features, metrics)
+        logs.append([year] + stats)
+
+    keys = ["year_importance" if key == "year" else key for key in keys]
+    results = pd.DataFrame(logs, columns=["year"] + keys)
+    return results, trained_models, dv_scalers
+
+
+def budget_cores(n_tasks, n_jobs=-1):
+    """
+    splits the available cores between the number of parallel tasks and the `n_jobs`
+    of the estimator inside each task so that the total does not oversubscribe.
+    """
+    n_cores = effective_n_jobs(n_jobs)
+    n_outer = max(1, min(n_cores, n_tasks))
+    n_inner = max(1, n_cores // n_outer)
+    return n_outer, n_inner
+
+
+def _regression_analysis_job(
+    df_y, vars_iv, var_dv, model, iv_scaler, dv_scaler, kwargs
+):
+    return regression_analysis(
+        df_y, vars_iv, var_dv, model, iv_scaler, dv_scaler, **kwargs
+    )
+
+
+@profiled
+def regression_analysis_yearly_parallel(
+    datasets,
+    vars_iv,
+    vars_dv,
+    model,
+    years=None,
+    iv_scaler=None,
+    dv_scaler=None,
+    n_jobs=-1,
+    **kwargs,
+):
+    """
+    runs `regression_analysis_yearly` for every (dataset, dependent variable, year) as
+    independent jobs in a process pool.
+
+    `datasets` is a dict of name -> long dataframe, e.g. the full data and the data
+    without outliers. Every job gets its own clone of `model` and of the scalers, with
+    the estimator's `n_jobs` reduced so that pool workers x estimator threads fit the
+    available cores. Returns `(results, trained_models, dv_scalers)` where
+    `results[name][var_dv]` is the table returned by `regression_analysis_yearly` and
+    `trained_models[name][var_dv][year]` is the model of that year. The years a dataset
+    does not have are skipped for that dataset.
+    """
+    if years is None:
+        years = sorted(set().union(*[df["year"].unique() for df in datasets.values()]))
+    years = list(years)
+    df_years = {
+        (name, year): df_y.copy()
+        for name, df in datasets.items()
+        for year, df_y in df.groupby("year")
+        if year in years
+    }
+    # a dataset without some of the years (e.g. an incremental panel next to the full
+    # one) only gets the jobs of the years it has
+    jobs = [
+        (name, var_dv, year)
+        for name in datasets
+        for var_dv in vars_dv
+        for year in years
+        if (name, year) in df_years
+    ]
+    if not jobs:
+        raise ValueError(f"no dataset has data for the years {years}")
+    n_outer, n_inner = budget_cores(len(jobs), n_jobs)
+    if "n_jobs" in model.get_params():
+        model = clone(model).set_params(n_jobs=n_inner)
+
+    outputs = Parallel(n_jobs=n_outer)(
+        delayed(_regression_analysis_job)(
+            df_years[(name, year)],
+            vars_iv,
+            var_dv,
+            clone(model),
+            None if iv_scaler is None else clone(iv_scaler),
+            None if dv_scaler is None else clone(dv_scaler),
+            kwargs,
+        )
+        for name, var_dv, year in jobs
+    )
+
+    results = {name: dict() for name in datasets}
+    trained_models = {name: {var_dv: dict() for var_dv in vars_dv} for name in datasets}
+    dv_scalers = {name: {var_dv: dict() for var_dv in vars_dv} for name in datasets}
+    logs = {(name, var_dv): [] for name in datasets for var_dv in vars_dv}
+    for (name, var_dv, year), (keys, stats, trained_model, dv_scaler_y) in zip(
+        jobs, outputs
+    ):
+        trained_models[name][var_dv][year] = trained_model
+        dv_scalers[name][var_dv][year] = dv_scaler_y
+        logs[(name, var_dv)].append([year] + stats)
+
+    for (name, var_dv), log in logs.items():
+        results[name][var_dv] = pd.DataFrame(log, columns=["year"] + keys)
+
+    return results, trained_models, dv_scalers
+
+
 def find_large_errors(y_test, y_pred, threshold):
     errors = abs(y_test - y_pred)
     large_errors = errors[errors > threshold]
     return large_errors
 
 
+@profiled(rows=len)
 def get_pred_n_outliers(
     df,
     vars_dv,
@@ -119,13 +436,12 @@ def get_pred_n_outliers(
     df_year = df_year.rename(columns={"y_pred": f"{vars_dv}_pred"})
 
     # Adjust outliers to reflect the sign of the residuals
-    df_year["outliers"] = df_year.apply(
-        lambda row: row["outliers"] * np.sign(row["residuals"]), axis=1
-    )
+    df_year["outliers"] = df_year["outliers"] * np.sign(df_year["residuals"])
 
     return df_year
 
 
+@profiled(rows=len)
 def get_pred_n_outliers_z_score(
     df,
     vars_dv,
@@ -167,8 +483,100 @@ def get_pred_n_outliers_z_score(
     df_year = df_year.rename(columns={"y_pred": f"{vars_dv}_pred"})
 
     # Adjust outliers to reflect the sign of the residuals
-    df_year["outliers"] = df_year.apply(
-        lambda row: row["outliers"] * np.sign(row["residuals"]), axis=1
-    )
+    df_year["outliers"] = df_year["outliers"] * np.sign(df_year["residuals"])
 
     return df_year
+
+
+@profiled(rows=len)
+def predict_residuals(df, vars_dv, vars_iv, models, years=None):
+    """
+    predictions, residuals and their per-year statistics for every dependent variable
+    in `vars_dv` and all `years`, with one prediction per (variable, year).
+    `models[var_dv][year]` is the model of that year, as returned by
+    `regression_analysis_yearly`. Returns a frame with `year`, `pref`, `muni` and the
+    `{var_dv}_pred`, `{var_dv}_residuals`, `{var_dv}_z_score` and `{var_dv}_std`
+    (sample standard deviation of the residuals of the year) columns.
+    """
+    if years is None:
+        years = sorted(df["year"].unique())
+
+    df_sel = df[df["year"].isin(years)].reset_index(drop=True)
+    year_codes = pd.Categorical(df_sel["year"], categories=years).codes
+    year_rows = [year_codes == i for i in range(len(years))]
+    counts = np.bincount(year_codes, minlength=len(years))
+    X = df_sel[vars_iv]
+
+    df_residuals = df_sel[["year", "pref", "muni"]].copy()
+    for var_dv in vars_dv:
+        y_pred = np.empty(len(df_sel))
+        for year, rows in zip(years, year_rows):
+            y_pred[rows] = models[var_dv][year].predict(X[rows])
+        residuals = df_sel[var_dv].to_numpy() - y_pred
+
+        # per year mean and sample standard deviation of the residuals
+        mean_residual = np.bincount(year_codes, residuals, len(years)) / counts
+        dev = residuals - mean_residual[year_codes]
+        std_residual = np.sqrt(
+            np.bincount(year_codes, dev**2, len(years)) / (counts - 1)
+        )
+
+        df_residuals[f"{var_dv}_pred"] = y_pred
+        df_residuals[f"{var_dv}_residuals"] = residuals
+        df_residuals[f"{var_dv}_z_score"] = dev / std_residual[year_codes]
+        df_residuals[f"{var_dv}_std"] = std_residual[year_codes]
+    return df_residuals
+
+
+def tag_outliers(df_residuals, var_dv, threshold_multiplier=1.96, method="z_score"):
+    """
+    signed outlier flags (-1, 0, 1) of `var_dv` from the output of
+    `predict_residuals`: |z-score| above `threshold_multiplier` (method="z_score") or
+    |residual| above `threshold_multiplier` standard deviations (method="std").
+    """
+    if method not in ["z_score", "std"]:
+        raise ValueError("Method must be either 'z_score' or 'std'")
+    residuals = df_residuals[f"{var_dv}_residuals"].to_numpy()
+    if method == "z_score":
+        is_outlier = np.abs(df_residuals[f"{var_dv}_z_score"]) > threshold_multiplier
+    else:
+        is_outlier = (
+            np.abs(residuals)
+            > threshold_multiplier * df_residuals[f"{var_dv}_std"].to_numpy()
+        )
+    return np.where(is_outlier, 1, 0) * np.sign(residuals)
+
+
+@profiled(rows=len)
+def get_pred_n_outliers_batch(
+    df,
+    vars_dv,
+    vars_iv,
+    models,
+    years=None,
+    threshold_multiplier=1.96,
+    method="z_score",
+):
+    """
+    predicts and tags the outliers of every dependent variable in `vars_dv` for all
+    `years` in one call. `models[var_dv][year]` is the model of that year, as returned
+    by `regression_analysis_yearly`.
+
+    The residual statistics are computed per year, the same as calling
+    `get_pred_n_outliers_z_score` (method="z_score") or `get_pred_n_outliers`
+    (method="std") year by year. Returns a frame with `year`, `pref`, `muni`, the signed
+    outlier flag of each dependent variable under its own name, and the
+    `{var_dv}_pred`, `{var_dv}_residuals` and `{var_dv}_z_score` columns.
+    """
+    if method not in ["z_score", "std"]:
+        raise ValueError("Method must be either 'z_score' or 'std'")
+    df_residuals = predict_residuals(df, vars_dv, vars_iv, models, years)
+
+    df_outliers = df_residuals[["year", "pref", "muni"]].copy()
+    for var_dv in vars_dv:
+        df_outliers[var_dv] = tag_outliers(
+            df_residuals, var_dv, threshold_multiplier, method
+        )
+        for col in ["pred", "residuals", "z_score"]:
+            df_outliers[f"{var_dv}_{col}"] = df_residuals[f"{var_dv}_{col}"]
+    return df_outliers
@@ -0,0 +1,178 @@
+"""
+Scalers of the long panel fitted once per year, or once on a reference, and applied
+to all years in one vectorized pass.
+
+`scale_data` fits its scaler on every call, so a scaler shared by the years of
+`regression_analysis_yearly` only keeps the state of the last year. `PanelScaler`
+keeps one fitted clone per year in `scalers_`. For the affine sklearn scalers
+(standard, robust, max-abs and min-max) their parameters are stacked into
+(year x column) arrays and every row is transformed with the parameters of its year,
+with the same floating point operations as the scaler's own `transform`. `fit` checks
+the parameters against each fitted scaler's `transform` on a few rows per year and
+uses the scalers themselves when they differ.
+"""
+
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.preprocessing import (
+    MaxAbsScaler,
+    MinMaxScaler,
+    RobustScaler,
+    StandardScaler,
+)
+
+
+def _affine_params(scaler, n_columns):
+    # (offset, scale, shift_first): x' = (x - offset) / scale, or x * scale + offset
+    # for MinMaxScaler. None for scalers that are not one of the affine ones.
+    ones, zeros = np.ones(n_columns), np.zeros(n_columns)
+    if isinstance(scaler, StandardScaler):
+        # mean_ is set even with with_mean=False, but transform does not subtract it
+        offset = zeros if not scaler.with_mean else scaler.mean_
+        scale = ones if not scaler.with_std else scaler.scale_
+        return offset, scale, True
+    if isinstance(scaler, RobustScaler):
+        offset = zeros if scaler.center_ is None else scaler.center_
+        scale = ones if scaler.scale_ is None else scaler.scale_
+        return offset, scale, True
+    if isinstance(scaler, MaxAbsScaler):
+        return zeros, scaler.scale_, True
+    if isinstance(scaler, MinMaxScaler) and not scaler.clip:
+        return scaler.min_, scaler.scale_, False
+    return None
+
+
+class PanelScaler:
+    """
+    one clone of `scaler` per year of the panel for `columns`. With `reference=None`
+    each year is fitted on its own rows, as `scale_data` does year by year; with
+    `reference="all"` one scaler is fitted on all rows and with `reference=<year>` on
+    the rows of that year, and is then used for every year, including years added
+    after the fit.
+    """
+
+    def __init__(self, scaler, columns, reference=None):
+        self.scaler = scaler
+        self.columns = list(columns)
+        self.reference = reference
+
+    def fit(self, df):
+        years = sorted(df["year"].unique())
+        if self.reference is None:
+            self.scalers_ = {
+                year: clone(self.scaler).fit(df.loc[df["year"] == year, self.columns])
+                for year in years
+            }
+        else:
+            rows = df if self.reference == "all" else df[df["year"] == self.reference]
+            fitted = clone(self.scaler).fit(rows[self.columns])
+            self.scalers_ = {year: fitted for year in years}
+
+        self.years_ = years
+        params = [_affine_params(s, len(self.columns)) for s in self.scalers_.values()]
+        if all(p is not None for p in params):
+            self.offset_ = np.stack([p[0] for p in params])
+            self.scale_ = np.stack([p[1] for p in params])
+            self.shift_first_ = params[0][2]
+            if not self._matches_scalers(df):
+                self.offset_ = self.scale_ = self.shift_first_ = None
+        else:
+            self.offset_ = self.scale_ = self.shift_first_ = None
+        return self
+
+    def _matches_scalers(self, df):
+        # the affine parameters must give what each fitted scaler's own transform
+        # gives; a few rows per year are checked, otherwise the scalers are used
+        probe = df.groupby("year").head(3)
+        fast = self._apply(probe[self.columns], probe["year"], False, self.columns)
+        for year, rows in probe.groupby("year").groups.items():
+            own = np.asarray(
+                self.scalers_[year].transform(probe.loc[rows, self.columns])
+            )
+            if not np.allclose(
+                fast[probe.index.get_indexer(rows)], own, rtol=1e-12, equal_nan=True
+            ):
+                return False
+        return True
+
+    def _year_codes(self, years):
+        if self.reference is not None:
+            # the single reference scaler also applies to years it has not seen
+            return np.zeros(len(years), dtype=np.intp)
+        codes = pd.Categorical(years, categories=self.years_).codes
+        if (codes == -1).any():
+            unknown = sorted(set(np.asarray(years)[codes == -1]))
+            raise ValueError(f"no fitted scaler for the years {unknown}")
+        return codes
+
+    def _apply(self, values, years, inverse, columns):
+        values = np.array(values, dtype=np.float64)
+        codes = self._year_codes(years)
+        pos = [self.columns.index(c) for c in columns]
+
+        if self.offset_ is None:
+            # scalers without affine parameters are applied year by year
+            out = np.empty_like(values)
+            for code in np.unique(codes):
+                scaler = self.scalers_[self.years_[code]]
+                rows = codes == code
+                # with the column names the scaler was fitted with
+                full = pd.DataFrame(
+                    np.zeros((rows.sum(), len(self.columns))), columns=self.columns
+                )
+                full.iloc[:, pos] = values[rows]
+                func = scaler.inverse_transform if inverse else scaler.transform
+                out[rows] = np.asarray(func(full))[:, pos]
+            return out
+
+        offset = self.offset_[:, pos][codes]
+        scale = self.scale_[:, pos][codes]
+        if self.shift_first_:
+            return values * scale + offset if inverse else (values - offset) / scale
+        return (values - offset) / scale if inverse else values * scale + offset
+
+    def transform(self, df, columns=None):
+        """
+        a copy of `df` with `columns` (all the fitted ones by default) scaled with
+        the scaler of the year of each row.
+        """
+        columns = self.columns if columns is None else list(columns)
+        df = df.copy()
+        df[columns] = self._apply(df[columns], df["year"], False, columns)
+        return df
+
+    def fit_transform(self, df):
+        return self.fit(df).transform(df)
+
+    def inverse_transform(self, df, columns=None):
+        columns = self.columns if columns is None else list(columns)
+        df = df.copy()
+        df[columns] = self._apply(df[columns], df["year"], True, columns)
+        return df
+
+    def inverse_transform_values(self, values, years, column):
+        """
+        `values` of `column` (e.g. predictions of the scaled dependent variable) back
+        in the original units, given the year of each value.
+        """
+        values = np.asarray(values, dtype=np.float64)[:, None]
+        return self._apply(values, np.asarray(years), True, [column])[:, 0]
+
+
+def scale_panel(
+    df, vars_iv=None, var_dv=None, iv_scaler=None, dv_scaler=None, reference=None
+):
+    """
+    `scale_data` for the whole panel: fits a `PanelScaler` for the independent and
+    one for the dependent variables and returns the scaled copy of `df` and the two
+    panel scalers.
+    """
+    iv_panel = dv_panel = None
+    if vars_iv and iv_scaler:
+        iv_panel = PanelScaler(iv_scaler, vars_iv, reference).fit(df)
+        df = iv_panel.transform(df)
+    if var_dv and dv_scaler:
+        dv_panel = PanelScaler(dv_scaler, [var_dv], reference).fit(df)
+        df = dv_panel.transform(df)
+    return df, iv_panel, dv_panel
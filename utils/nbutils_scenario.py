@@ -0,0 +1,164 @@
+"""
+What-if scenarios for the proactive outlier selection of notebook 04.
+
+A scenario scales the independent variables of every municipality by a set of
+factors. For each scenario and municipality the engine gives the RFR prediction, the
+SHAP score and `inc_ratio` of `score_outliers`, and the cluster predicted by the RFC.
+The SHAP score is the sum of the SHAP values plus the expected value, which by the
+additivity of TreeSHAP equals the RFR prediction, so it is computed as the prediction
+without running the explainer.
+
+Scenarios are evaluated in batches of `batch_size` in joblib workers, each loading
+the pickled forests once (`load_forest`) and predicting all the rows of a batch in one
+call, and the results are streamed to a parquet file one batch at a time.
+"""
+
+import itertools
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from joblib import Parallel, delayed, effective_n_jobs
+
+from utils.nbutils_forest import load_forest
+from utils.nbutils_profile import profiled
+
+vars_iv = ["demand", "land_avail", "taxable_income", "LV", "SPR", "pv_out"]
+
+
+def make_scenario_grid(factors, vars_iv=vars_iv):
+    """
+    every combination of the scale factors in `factors`, a dict of variable -> list of
+    factors. Variables not in `factors` keep a factor of 1. Returns one row per
+    scenario with a `scenario_id` and a `{var}_factor` column per variable.
+    """
+    unknown = set(factors) - set(vars_iv)
+    if unknown:
+        raise ValueError(f"unknown variables in the scenario grid: {sorted(unknown)}")
+
+    levels = [factors.get(var, [1.0]) for var in vars_iv]
+    grid = pd.DataFrame(
+        list(itertools.product(*levels)), columns=[f"{var}_factor" for var in vars_iv]
+    ).astype(float)
+    grid.insert(0, "scenario_id", np.arange(len(grid)))
+    return grid
+
+
+def _scenario_batch(X_base, actual, factors, start, rfr_path, rfc_path, vars_iv):
+    # rows are ordered by scenario, then by municipality
+    n_scenarios, n_muni = len(factors), len(X_base)
+    X = pd.DataFrame(
+        (factors[:, None, :] * X_base[None, :, :]).reshape(-1, X_base.shape[1]),
+        columns=vars_iv,
+    )
+
+    pred = load_forest(rfr_path).predict(X)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inc_ratio = np.tile(actual, n_scenarios) / pred
+    return {
+        "scenario_pos": np.repeat(np.arange(start, start + n_scenarios), n_muni),
+        "muni_pos": np.tile(np.arange(n_muni), n_scenarios),
+        "pred": pred,
+        "inc_ratio": inc_ratio,
+        "cluster_p": load_forest(rfc_path).predict(X),
+    }
+
+
+@profiled
+def run_scenarios(
+    df_base,
+    vars_dv,
+    grid,
+    rfr_path,
+    rfc_path,
+    out_fn,
+    vars_iv=vars_iv,
+    batch_size=50,
+    n_jobs=-1,
+):
+    """
+    evaluates every scenario of `grid` (see `make_scenario_grid`) on the
+    municipalities of `df_base`, which holds `pref`, `muni`, `vars_iv` and the actual
+    `vars_dv`, e.g. `df[df["year"] == 2023]`. `rfr_path` and `rfc_path` are the
+    pickled models.
+
+    `out_fn` is a parquet file with one row per scenario and municipality: the
+    scenario's factors, `{vars_dv}` (actual), `{vars_dv}_shap`, `inc_ratio` and
+    `cluster_p`. Returns the number of rows written.
+    """
+    if len(grid) == 0:
+        raise ValueError("the scenario grid is empty")
+
+    df_base = df_base.reset_index(drop=True)
+    X_base = df_base[vars_iv].to_numpy(dtype=np.float64)
+    actual = df_base[vars_dv].to_numpy(dtype=np.float64)
+    factor_cols = [f"{var}_factor" for var in vars_iv]
+    factors = grid[factor_cols].to_numpy(dtype=np.float64)
+    scenario_ids = grid["scenario_id"].to_numpy()
+    # missing keys stay null, as in `pv_params`, so that the rows join back to it
+    keys = {c: pa.array(df_base[c]).dictionary_encode() for c in ["pref", "muni"]}
+
+    batches = range(0, len(grid), batch_size)
+    outputs = Parallel(
+        n_jobs=min(effective_n_jobs(n_jobs), len(batches)), return_as="generator"
+    )(
+        delayed(_scenario_batch)(
+            X_base,
+            actual,
+            factors[start : start + batch_size],
+            start,
+            rfr_path,
+            rfc_path,
+            vars_iv,
+        )
+        for start in batches
+    )
+
+    n_rows = 0
+    writer = None
+    try:
+        for output in outputs:
+            scenario_pos = output["scenario_pos"]
+            muni_pos = output["muni_pos"]
+            columns = {
+                "scenario_id": scenario_ids[scenario_pos],
+                "pref": keys["pref"].take(muni_pos),
+                "muni": keys["muni"].take(muni_pos),
+            }
+            for i, col in enumerate(factor_cols):
+                columns[col] = factors[scenario_pos, i]
+            columns[vars_dv] = actual[muni_pos]
+            columns[f"{vars_dv}_shap"] = output["pred"]
+            columns["inc_ratio"] = output["inc_ratio"]
+            columns["cluster_p"] = output["cluster_p"]
+
+            table = pa.table(columns)
+            if writer is None:
+                writer = pq.ParquetWriter(out_fn + ".tmp", table.schema)
+            writer.write_table(table)
+            n_rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+
+    os.replace(out_fn + ".tmp", out_fn)
+    return n_rows
+
+
+def scenario_summary(out_fn, vars_dv, inc_ratio_min):
+    """
+    per scenario, the number of municipalities above `inc_ratio_min` (the proactive
+    ones of `select_proactive`) and the mean SHAP score, read column by column from
+    the output of `run_scenarios`.
+    """
+    df = pd.read_parquet(
+        out_fn, columns=["scenario_id", f"{vars_dv}_shap", "inc_ratio"]
+    )
+    df["proactive"] = df["inc_ratio"] > inc_ratio_min
+    return df.groupby("scenario_id").agg(
+        n_proactive=("proactive", "sum"),
+        shap_mean=(f"{vars_dv}_shap", "mean"),
+        inc_ratio_median=("inc_ratio", "median"),
+    )
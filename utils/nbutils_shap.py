@@ -1,46 +1,201 @@
+import hashlib
+import os
+
+import joblib
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 
-from sklearn.ensemble import RandomForestRegressor
+from joblib import Parallel, delayed
 from sklearn.metrics import r2_score
+from sklearn.pipeline import Pipeline
 import shap
 
+from utils.nbutils_estimators import final_estimator, make_estimator
+from utils.nbutils_profile import profiled
 
-def plot_feature_importance_base(df, vars_dv, year):
-    # Filter the DataFrame for the year 2023
-    df_temp = df[df["year"] == year]
+vars_iv_shap = ["demand", "land_avail", "taxable_income", "LV", "SPR", "pv_out"]
+
+
+# ============================================================================ #
+# Fingerprints
+# ============================================================================ #
+def data_hash(X):
+    """
+    content hash of a dataframe, including its column names but not its index.
+    """
+    h = hashlib.sha256()
+    h.update(",".join(map(str, X.columns)).encode())
+    h.update(pd.util.hash_pandas_object(X, index=False).to_numpy().tobytes())
+    return h.hexdigest()[:16]
 
-    # Define independent and dependent variables
-    vars_iv = ["demand", "land_avail", "taxable_income", "LV", "SPR", "pv_out"]
-    X = df_temp[vars_iv]
-    y = df_temp[vars_dv]
 
-    # Train the model
-    model = RandomForestRegressor(random_state=42)
+def model_fingerprint(model):
+    """
+    hash of a (fitted or unfitted) estimator, parameters and learned state included.
+    Trees are hashed through their node arrays since their pickled form is not stable
+    across a dump/load round trip.
+    """
+    h = hashlib.sha256()
+    h.update(type(model).__name__.encode())
+    h.update(joblib.hash(model.get_params()).encode())
+
+    trees = [
+        est.tree_
+        for est in getattr(model, "estimators_", [model])
+        if hasattr(est, "tree_")
+    ]
+    for tree in trees:
+        for arr in [
+            tree.children_left,
+            tree.children_right,
+            tree.feature,
+            tree.threshold,
+            tree.value,
+        ]:
+            h.update(np.ascontiguousarray(arr).tobytes())
+    if not trees:
+        h.update(joblib.hash(model).encode())
+    return h.hexdigest()[:16]
+
+
+# ============================================================================ #
+# Training and explanation
+# ============================================================================ #
+@profiled(rows="X")
+def train_shap_model(X, y, random_state=42, cache_dir=None, estimator="rf"):
+    """
+    fits the model explained by SHAP, the `RandomForestRegressor` by default or another
+    backend of `make_estimator`. With `cache_dir`, the fitted model is stored keyed by
+    the estimator parameters and the training data.
+    """
+    model = make_estimator(estimator, random_state=random_state)
+    if cache_dir is not None:
+        key = f"{model_fingerprint(model)}-{data_hash(pd.concat([X, y], axis=1))}"
+        fn = os.path.join(cache_dir, f"model-{key}.joblib")
+        if os.path.exists(fn):
+            return joblib.load(fn)
 
     model.fit(X, y)
 
-    # Calculate SHAP values
-    explainer = shap.TreeExplainer(model)
-    shap_values = explainer.shap_values(X)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        joblib.dump(model, fn + ".tmp", compress=3)
+        os.replace(fn + ".tmp", fn)
+    return model
 
-    # Predict and calculate residuals
-    predictions = model.predict(X)
-    residuals = y - predictions
 
-    # Summary plot
-    shap.summary_plot(shap_values, X, feature_names=vars_iv)
+@profiled(rows="X")
+def compute_shap_values(model, X, cache_dir=None):
+    """
+    TreeSHAP values of `model` on `X` and the explainer's expected value, or the exact
+    SHAP values of the linear backends. With `cache_dir`, the values are stored keyed
+    by the model fingerprint and the hash of `X`, so they are never recomputed for
+    unchanged inputs.
+    """
+    if cache_dir is not None:
+        key = f"{model_fingerprint(model)}-{data_hash(X)}"
+        fn = os.path.join(cache_dir, f"shap-{key}.npz")
+        if os.path.exists(fn):
+            with np.load(fn) as cached:
+                return cached["shap_values"], float(cached["expected_value"])
 
-    # Bar plot to rank feature importance
-    shap.summary_plot(shap_values, X, plot_type="bar", feature_names=vars_iv)
+    if hasattr(final_estimator(model), "coef_"):
+        shap_values, expected_value = linear_shap_values(model, X)
+    else:
+        explainer = shap.TreeExplainer(model)
+        shap_values = explainer.shap_values(X)
+        expected_value = float(np.ravel(explainer.expected_value)[0])
 
-    shap_scores_df = pd.DataFrame(shap_values, columns=vars_iv)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(fn + ".tmp", "wb") as f:
+            np.savez(f, shap_values=shap_values, expected_value=expected_value)
+        os.replace(fn + ".tmp", fn)
+    return shap_values, expected_value
 
-    shap_pred = shap_scores_df.sum(axis=1) + explainer.expected_value
 
-    print("r2:", r2_score(shap_pred, y))
+def linear_shap_values(model, X):
+    """
+    SHAP values of a linear backend of `make_estimator`. Its features are standardized
+    on the training data, whose mean is then 0, so the SHAP value of a feature is its
+    coefficient times the standardized value and the expected value is the intercept.
+    """
+    Z = model[:-1].transform(X) if isinstance(model, Pipeline) else np.asarray(X)
+    linear = final_estimator(model)
+    return Z * np.ravel(linear.coef_), float(np.ravel(linear.intercept_)[0])
+
+
+def _shap_year_job(X, y, random_state, cache_dir, estimator):
+    model = train_shap_model(
+        X, y, random_state=random_state, cache_dir=cache_dir, estimator=estimator
+    )
+    shap_values, expected_value = compute_shap_values(model, X, cache_dir=cache_dir)
+    return model, shap_values, expected_value
+
+
+@profiled(rows="df")
+def compute_shap_yearly(
+    df,
+    vars_dv,
+    years,
+    vars_iv=vars_iv_shap,
+    random_state=42,
+    cache_dir=None,
+    n_jobs=-1,
+    estimator="rf",
+):
+    """
+    trains and explains one model per year in parallel worker processes.
+    Returns a dict of year -> dict(model, X, y, shap_values, expected_value).
+    """
+    data = dict()
+    for year in years:
+        df_temp = df[df["year"] == year]
+        data[year] = (df_temp[vars_iv], df_temp[vars_dv])
+
+    outputs = Parallel(n_jobs=min(joblib.effective_n_jobs(n_jobs), len(data)))(
+        delayed(_shap_year_job)(X, y, random_state, cache_dir, estimator)
+        for X, y in data.values()
+    )
+
+    shap_yearly = dict()
+    for (year, (X, y)), (model, shap_values, expected_value) in zip(
+        data.items(), outputs
+    ):
+        shap_yearly[year] = {
+            "model": model,
+            "X": X,
+            "y": y,
+            "shap_values": shap_values,
+            "expected_value": expected_value,
+        }
+    return shap_yearly
+
+
+def build_shap_summary(df_sample, shap_values, expected_value, vars_iv, vars_dv):
+    """
+    the `shap_values_summary_{vars_dv}.csv` table without the cluster column: the
+    sample's keys, variables and SHAP score of each variable, and their sum as
+    `{vars_dv}_shap`.
+    """
+    from utils.japan_admin_data import prefecture_dict_jp_to_en, muni_en_map
+
+    df_scores = pd.DataFrame(shap_values, columns=[c + "_score" for c in vars_iv])
+    df_sample = df_sample[["pref", "muni"] + vars_iv + [vars_dv]].reset_index(drop=True)
 
+    shap_scores_summary_df = pd.concat([df_sample, df_scores], axis=1)
+    shap_scores_summary_df[f"{vars_dv}_shap"] = df_scores.sum(axis=1) + expected_value
+    shap_scores_summary_df["pref_en"] = shap_scores_summary_df["pref"].map(
+        prefecture_dict_jp_to_en
+    )
+    shap_scores_summary_df["muni_en"] = shap_scores_summary_df["muni"].map(
+        muni_en_map()
+    )
+    return shap_scores_summary_df
+
+
+def get_shap_importance(shap_values, vars_iv):
     mean_abs_shap_values = np.mean(np.abs(shap_values), axis=0)
     shap_importance_df = pd.DataFrame.from_dict(
         {"mean_abs": mean_abs_shap_values}, orient="index", columns=vars_iv
@@ -50,6 +205,27 @@ def plot_feature_importance_base(df, vars_dv, year):
         .loc["mean_abs"]
         .to_dict()
     )
+    return shap_importance_df
+
+
+# ============================================================================ #
+# Plots
+# ============================================================================ #
+@profiled(rows="X")
+def plot_shap_values(shap_values, X, vars_iv, expected_value, y):
+    # Summary plot
+    shap.summary_plot(shap_values, X, feature_names=vars_iv)
+
+    # Bar plot to rank feature importance
+    shap.summary_plot(shap_values, X, plot_type="bar", feature_names=vars_iv)
+
+    shap_scores_df = pd.DataFrame(shap_values, columns=vars_iv)
+
+    shap_pred = shap_scores_df.sum(axis=1) + expected_value
+
+    print("r2:", r2_score(shap_pred, y))
+
+    shap_importance_df = get_shap_importance(shap_values, vars_iv)
     print("Normalized SHAP Feature Importance")
     print(shap_importance_df)
 
@@ -58,3 +234,21 @@ def plot_feature_importance_base(df, vars_dv, year):
     shap_scores_df.plot(ax=ax, x="demand", y="land_avail", lw=0, marker=".")
     ax.axvline(x=0, color="r", linestyle="--", linewidth=2)
     ax.axhline(y=0, color="r", linestyle="--", linewidth=2)
+    return fig, ax
+
+
+@profiled
+def plot_feature_importance_base(df, vars_dv, year, cache_dir=None):
+    # Filter the DataFrame for the year
+    df_temp = df[df["year"] == year]
+
+    # Define independent and dependent variables
+    vars_iv = vars_iv_shap
+    X = df_temp[vars_iv]
+    y = df_temp[vars_dv]
+
+    # Train the model and calculate SHAP values
+    model = train_shap_model(X, y, random_state=42, cache_dir=cache_dir)
+    shap_values, expected_value = compute_shap_values(model, X, cache_dir=cache_dir)
+
+    plot_shap_values(shap_values, X, vars_iv, expected_value, y)
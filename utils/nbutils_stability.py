@@ -0,0 +1,207 @@
+"""
+Resampling estimates of the uncertainty of the yearly regressions.
+
+`regression_analysis_yearly` scores each year on a single train/test split. Here
+every (PV type, year) is refit on bootstrap samples (scored on the out-of-bag rows)
+or on the folds of repeated K-fold splits, and every metric and importance column
+gets a percentile confidence interval. The fits run in joblib workers in rounds, and
+a (PV type, year) stops once its intervals move by less than `tol` of their width
+between two rounds.
+
+Each fit draws its sample and the estimator's `random_state` from a
+`numpy.random.SeedSequence` keyed by the PV type, the year and the replicate number,
+so the results do not depend on the number of workers or on the round sizes.
+"""
+
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.base import clone
+from sklearn.model_selection import KFold
+
+from utils.nbutils_profile import profiled
+from utils.nbutils_regression import (
+    budget_cores,
+    fit_and_score,
+    get_model_stats,
+    scale_data,
+)
+
+
+def _replicate_seed(random_state, dv_pos, year, replicate, method, n_splits):
+    # the folds of one K-fold repetition share the seed of the repetition
+    if method == "kfold":
+        replicate = replicate // n_splits
+    return np.random.SeedSequence(
+        random_state, spawn_key=(dv_pos, int(year), replicate)
+    )
+
+
+def _resample_split(n_rows, method, n_splits, seed, replicate):
+    rng = np.random.default_rng(seed)
+    if method == "bootstrap":
+        train = rng.integers(0, n_rows, n_rows)
+        test = np.setdiff1d(np.arange(n_rows), train)
+    else:
+        folds = KFold(n_splits, shuffle=True, random_state=int(rng.integers(2**31 - 1)))
+        train, test = list(folds.split(np.empty(n_rows)))[replicate % n_splits]
+    model_seed = int(rng.integers(2**31 - 1))
+    return train, test, model_seed
+
+
+def _stability_job(X, y, model, vars_iv, method, n_splits, seed, replicate, kwargs):
+    train, test, model_seed = _resample_split(len(X), method, n_splits, seed, replicate)
+    model = clone(model)
+    if "random_state" in model.get_params():
+        model.set_params(random_state=model_seed)
+    trained_model, r2, mae, mse, rmse = fit_and_score(
+        X.iloc[train], X.iloc[test], y.iloc[train], y.iloc[test], model, **kwargs
+    )
+    return get_model_stats(trained_model, vars_iv, [r2, mae, mse, rmse])
+
+
+def _interval(df_rep, keys, alpha):
+    values = df_rep[keys]
+    return (
+        values.quantile(alpha / 2).to_numpy(),
+        values.quantile(1 - alpha / 2).to_numpy(),
+    )
+
+
+def _has_converged(interval, interval_prev, tol):
+    # largest move of a bound between two rounds, relative to the interval width
+    if interval_prev is None:
+        return False
+    (lo, hi), (lo_prev, hi_prev) = interval, interval_prev
+    width = np.maximum(hi - lo, 1e-12)
+    shift = np.maximum(np.abs(lo - lo_prev), np.abs(hi - hi_prev))
+    return bool(np.all(shift <= tol * width))
+
+
+@profiled
+def regression_stability(
+    df,
+    vars_iv,
+    vars_dv,
+    model,
+    years=None,
+    method="bootstrap",
+    n_splits=5,
+    min_replicates=20,
+    max_replicates=200,
+    round_size=None,
+    alpha=0.05,
+    tol=0.05,
+    iv_scaler=None,
+    dv_scaler=None,
+    random_state=42,
+    n_jobs=-1,
+    **kwargs,
+):
+    """
+    bootstrap (`method="bootstrap"`) or repeated K-fold (`method="kfold"`) fits of
+    `model` for every PV type of `vars_dv` and every year. The data of each year is
+    scaled once, as in `regression_analysis`, then resampled.
+
+    Fits run in rounds of `round_size` replicates (`min_replicates` by default,
+    rounded up to whole K-fold repetitions) until the `1 - alpha` intervals of a
+    (PV type, year) converge or `max_replicates` is reached.
+
+    Returns a summary with one row per (PV type, year, statistic): the number of
+    replicates, mean, std, interval bounds and whether it converged; and the table
+    of all replicates.
+    """
+    if method not in ["bootstrap", "kfold"]:
+        raise ValueError(f"unknown resampling method: {method}")
+    if years is None:
+        years = sorted(df["year"].unique())
+    round_size = min_replicates if round_size is None else round_size
+    if method == "kfold":
+        round_size = -(-round_size // n_splits) * n_splits
+
+    data = dict()
+    for dv_pos, var_dv in enumerate(vars_dv):
+        for year in years:
+            df_y, _, _ = scale_data(
+                df[df["year"] == year].copy(),
+                vars_iv,
+                var_dv,
+                None if iv_scaler is None else clone(iv_scaler),
+                None if dv_scaler is None else clone(dv_scaler),
+            )
+            data[(var_dv, year)] = (dv_pos, df_y[vars_iv], df_y[var_dv])
+
+    n_outer, n_inner = budget_cores(len(data) * round_size, n_jobs)
+    model = clone(model)
+    if "n_jobs" in model.get_params():
+        model.set_params(n_jobs=n_inner)
+
+    replicates = {group: [] for group in data}
+    intervals = {group: None for group in data}
+    converged = {group: False for group in data}
+    keys = None
+    with Parallel(n_jobs=n_outer) as parallel:
+        while True:
+            pending = [
+                group
+                for group in data
+                if not converged[group] and len(replicates[group]) < max_replicates
+            ]
+            if not pending:
+                break
+
+            tasks = []
+            for group in pending:
+                dv_pos, X, y = data[group]
+                start = len(replicates[group])
+                for replicate in range(start, min(start + round_size, max_replicates)):
+                    seed = _replicate_seed(
+                        random_state, dv_pos, group[1], replicate, method, n_splits
+                    )
+                    tasks.append((group, replicate, X, y, seed))
+
+            outputs = parallel(
+                delayed(_stability_job)(
+                    X, y, model, vars_iv, method, n_splits, seed, replicate, kwargs
+                )
+                for _, replicate, X, y, seed in tasks
+            )
+            for (group, replicate, *_), (keys, stats) in zip(tasks, outputs):
+                replicates[group].append([replicate] + stats)
+
+            for group in pending:
+                n_done = len(replicates[group])
+                df_rep = pd.DataFrame(replicates[group], columns=["replicate"] + keys)
+                interval = _interval(df_rep, keys, alpha)
+                if n_done >= min_replicates:
+                    converged[group] = _has_converged(interval, intervals[group], tol)
+                intervals[group] = interval
+
+    df_replicates = []
+    summary = []
+    for (var_dv, year), rows in replicates.items():
+        df_rep = pd.DataFrame(rows, columns=["replicate"] + keys)
+        df_rep.insert(0, "year", year)
+        df_rep.insert(0, "var_dv", var_dv)
+        df_replicates.append(df_rep)
+
+        lo, hi = intervals[(var_dv, year)]
+        summary.append(
+            pd.DataFrame(
+                {
+                    "var_dv": var_dv,
+                    "year": year,
+                    "stat": keys,
+                    "n": len(df_rep),
+                    "mean": df_rep[keys].mean().to_numpy(),
+                    "std": df_rep[keys].std().to_numpy(),
+                    "ci_lo": lo,
+                    "ci_hi": hi,
+                    "converged": converged[(var_dv, year)],
+                }
+            )
+        )
+    return (
+        pd.concat(summary, ignore_index=True),
+        pd.concat(df_replicates, ignore_index=True),
+    )
@@ -0,0 +1,448 @@
+"""
+Headless version of the analysis notebooks expressed as a dependency graph.
+
+    outliers (02) -> shap_PV_R (03a), shap_PV_S (03b) -> proactive (04)
+
+Each stage declares the files it reads and writes and its parameters. A stage is
+re-run only when the fingerprint of its inputs, parameters and code changed or when
+one of its outputs is missing or was modified. Stages whose dependencies are complete
+run in parallel processes.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import joblib
+import pandas as pd
+from sklearn.metrics import accuracy_score, mean_absolute_error, r2_score
+from sklearn.model_selection import train_test_split
+
+from utils.nbutils_cache import file_hash
+from utils.nbutils_estimators import make_estimator
+from utils.nbutils_forest import load_compiled_forest
+from utils.nbutils_kmeans import cluster_shap_scores
+from utils.nbutils_cluster_stats import get_pref_muni_isin
+from utils.nbutils_load_data import (
+    load_and_process_data,
+    build_df_for_analysis,
+    get_scale_param,
+)
+from utils.nbutils_muni_index import get_muni_key_index
+from utils.nbutils_outlier_cube import OutlierCube
+from utils.nbutils_proactive import (
+    get_cluster_pv_range,
+    score_outliers,
+    select_proactive,
+)
+from utils.nbutils_regression import (
+    regression_analysis_yearly,
+    get_pred_n_outliers_batch,
+)
+from utils.nbutils_shap import build_shap_summary, compute_shap_values
+
+ftr_pref_muni = ["pref", "muni"]
+vars_iv = ["demand", "land_avail", "taxable_income", "LV", "SPR", "pv_out"]
+pv_types = ["PV_R", "PV_S"]
+stamp_folder = ".pipeline"
+
+# backends of `make_estimator` for the RFR and RFC models of every stage
+estimator_backends = {"regressor": "rf", "classifier": "rf"}
+
+# every utils module is part of the code version of every stage
+utils_files = sorted(glob.glob(os.path.join(os.path.dirname(__file__), "*.py")))
+
+
+# ============================================================================ #
+# Stages
+# ============================================================================ #
+def stage_outliers(folder, params, n_jobs=-1):
+    """
+    02-extract-outlier: yearly RFR per PV type, outlier tagging and the extreme outlier
+    summary in `pv_growth_outlier.csv`.
+    """
+    year = params["year"]
+    pv_params, df = load_and_process_data(folder)
+
+    all_models = dict()
+    for var_dv in pv_types:
+        model = make_estimator(
+            params["estimators"]["regressor"],
+            random_state=params["random_state"],
+            n_jobs=n_jobs,
+            **params["estimator_params"],
+        )
+        _, all_models[var_dv], _ = regression_analysis_yearly(
+            df, vars_iv, var_dv, model
+        )
+
+    df_outliers = get_pred_n_outliers_batch(
+        df,
+        pv_types,
+        vars_iv,
+        all_models,
+        threshold_multiplier=params["threshold_multiplier"],
+    )
+
+    # municipality with at least 1 outlier and the extreme cases. The published table
+    # has the counts as floats.
+    cube = OutlierCube.from_outliers(df_outliers, pv_params, pv_types)
+    is_extreme = cube.extremes(params["outlier_limits"])
+    df_outlier_extremes = cube.counts_frame(is_extreme).astype(float)
+    outliers_index = df_outlier_extremes.index.to_list()
+
+    # consolidate information about the extreme outliers for analysis
+    cols_int = ["demand", "land_avail", "pv_out", "taxable_income", "LV"]
+    cols_percent = ["SPR", "PV_R", "PV_S", "PV_A"]
+    cols_percent += [f"{var_dv}_{year}_pred" for var_dv in pv_types]
+
+    df_temp2 = df_outliers[df_outliers["year"] == year].set_index(ftr_pref_muni)
+    df_temp2 = df_temp2[[f"{var_dv}_pred" for var_dv in pv_types]]
+    df_temp2.columns = [f"{var_dv}_{year}_pred" for var_dv in pv_types]
+    df_temp2 = df_temp2[df_temp2.index.isin(outliers_index)]
+
+    df_temp3 = df_outlier_extremes.copy()
+    df_temp3.columns = [c + "_out" for c in df_temp3.columns]
+
+    df_temp = df[df["year"] == year]
+    df_temp = get_pref_muni_isin(df_temp, outliers_index)
+    df_temp = pd.concat(
+        [df_temp.set_index(ftr_pref_muni), df_temp2, df_temp3], axis=1
+    ).reset_index()
+
+    from utils.japan_admin_data import prefecture_dict_jp_to_en, muni_en_map
+
+    df_temp["pref_en"] = df_temp["pref"].map(prefecture_dict_jp_to_en)
+    df_temp["muni_en"] = df_temp["muni"].map(muni_en_map())
+    df_temp["taxable_income"] = df_temp["taxable_income"].div(1_000)
+    df_temp[cols_int] = df_temp[cols_int].applymap(int)
+    df_temp[cols_percent] = df_temp[cols_percent].applymap(lambda x: round(x, 4))
+    df_temp.to_csv(os.path.join(folder, "pv_growth_outlier.csv"), index=False)
+
+
+def stage_shap(folder, params, n_jobs=-1):
+    """
+    03a/03b-shap: pooled RFR without the outliers, SHAP values of the sample year,
+    KMeans clustering of the SHAP scores and the RFC that predicts the cluster.
+    """
+    vars_dv = params["vars_dv"]
+    year = params["year"]
+    pv_params, _ = load_and_process_data(folder, build_df=False)
+
+    outlier_summary = pd.read_csv(os.path.join(folder, "pv_growth_outlier.csv"))
+    is_outlier = get_muni_key_index().isin(pv_params, outlier_summary[ftr_pref_muni])
+    df = build_df_for_analysis(pv_params, mask=~is_outlier)
+
+    # train with part of the 10-year data
+    X_train, X_test, y_train, y_test = train_test_split(
+        df[vars_iv], df[vars_dv], test_size=params["test_size"], random_state=42
+    )
+    model = make_estimator(
+        params["estimators"]["regressor"], random_state=42, n_jobs=n_jobs
+    )
+    model.fit(X_train, y_train)
+    y_pred = model.predict(X_test)
+    print(
+        f"{vars_dv} RFR r2: {r2_score(y_test, y_pred):.4f}",
+        f"mae: {mean_absolute_error(y_test, y_pred):.4f}",
+    )
+    joblib.dump(model, os.path.join(folder, f"model_RFR_{vars_dv}.joblib"), compress=3)
+
+    # SHAP values of the sample year
+    df_sample = df[df["year"] == year]
+    shap_values, expected_value = compute_shap_values(
+        model, df_sample[vars_iv], cache_dir=os.path.join(folder, params["shap_cache"])
+    )
+    shap_scores_summary_df = build_shap_summary(
+        df_sample, shap_values, expected_value, vars_iv, vars_dv
+    )
+
+    # cluster the SHAP scores and order the clusters by their mean SHAP value
+    shap_scores_summary_df = cluster_shap_scores(
+        shap_scores_summary_df,
+        vars_dv,
+        params["optimal_k"],
+        columns=[f"{c}_score" for c in vars_iv],
+    )
+    shap_scores_summary_df.to_csv(
+        os.path.join(folder, f"shap_values_summary_{vars_dv}.csv"), index=False
+    )
+
+    # random forest classifier of the cluster
+    X_train, X_test, y_train, y_test = train_test_split(
+        shap_scores_summary_df[vars_iv],
+        shap_scores_summary_df["kmeans_cluster"],
+        test_size=0.2,
+        random_state=42,
+    )
+    rf_clf = make_estimator(
+        params["estimators"]["classifier"], "classifier", random_state=42, n_jobs=n_jobs
+    )
+    rf_clf.fit(X_train, y_train)
+    print(
+        f"{vars_dv} RFC accuracy: {accuracy_score(y_test, rf_clf.predict(X_test)):.2f}"
+    )
+    if "n_jobs" in rf_clf.get_params():
+        rf_clf.set_params(n_jobs=None)
+    joblib.dump(
+        rf_clf,
+        os.path.join(folder, f"model_RFC_{vars_dv}_{year}.joblib"),
+        compress=3,
+    )
+
+
+def stage_proactive(folder, params, n_jobs=-1):
+    """
+    04-proactive-outlier-sel: outliers whose actual capacity share is well above what
+    the SHAP explanation of the pooled RFR gives, in `proactive_outliers.csv`.
+    """
+    year = params["year"]
+    pv_params, df = load_and_process_data(folder)
+    df_year = df[df["year"] == year]
+
+    outlier_summary = pd.read_csv(os.path.join(folder, "pv_growth_outlier.csv"))
+    is_outlier = get_muni_key_index().isin(pv_params, outlier_summary[ftr_pref_muni])
+    pv_param_no_outliers = pv_params[~is_outlier]
+    pv_param_outliers = pv_params[is_outlier]
+    scale_param = get_scale_param()
+
+    selected_outliers = dict()
+    for vars_dv in pv_types:
+        model_rfr = joblib.load(os.path.join(folder, f"model_RFR_{vars_dv}.joblib"))
+        model_rfc_fn = os.path.join(folder, f"model_RFC_{vars_dv}_{year}.joblib")
+        if params["estimators"]["classifier"] == "rf":
+            # a few dozen outliers, where the compiled forest beats sklearn's predict
+            model_rfc = load_compiled_forest(model_rfc_fn)
+        else:
+            model_rfc = joblib.load(model_rfc_fn)
+        shap_score_summary = pd.read_csv(
+            os.path.join(folder, f"shap_values_summary_{vars_dv}.csv")
+        )
+        cluster_index = {
+            kmean_no: df_g[ftr_pref_muni]
+            for kmean_no, df_g in shap_score_summary.groupby("kmeans_cluster")
+        }
+        scale_param_temp = scale_param.copy()
+        scale_param_temp.loc[vars_dv] = {
+            "unit": "%",
+            "scaler": 1,
+            "unit_scaled": "%",
+            "mean_sno": 2,
+            "std_sno": 2,
+        }
+        cluster_pv_range = get_cluster_pv_range(
+            df_year, cluster_index, scale_param_temp, vars_dv
+        )
+        selected_outliers[vars_dv] = score_outliers(
+            pv_param_outliers,
+            pv_param_no_outliers,
+            vars_dv,
+            vars_iv,
+            model_rfr,
+            model_rfc,
+            cluster_pv_range,
+            scale_param,
+            year=year,
+        )
+
+    so_stats = select_proactive(selected_outliers, params["inc_ratio_min"])
+    so_stats.to_csv(os.path.join(folder, "proactive_outliers.csv"), index=False)
+
+
+def get_stages(folder="data"):
+    """
+    the stage graph. Inputs and outputs are paths relative to `folder`.
+    """
+    stages = {
+        "outliers": {
+            "func": stage_outliers,
+            "deps": [],
+            "inputs": ["pv_muni_params.csv", "japanadmincode.csv"],
+            "outputs": ["pv_growth_outlier.csv"],
+            "params": {
+                "estimators": estimator_backends,
+                "estimator_params": {"n_estimators": 100},
+                "random_state": 58,
+                "threshold_multiplier": 3,
+                "outlier_limits": {"PV_R": [-7, 7], "PV_S": [-7, 7]},
+                "year": 2023,
+            },
+        },
+    }
+    for vars_dv in pv_types:
+        stages[f"shap_{vars_dv}"] = {
+            "func": stage_shap,
+            "deps": ["outliers"],
+            "inputs": [
+                "pv_muni_params.csv",
+                "japanadmincode.csv",
+                "pv_growth_outlier.csv",
+            ],
+            "outputs": [
+                f"model_RFR_{vars_dv}.joblib",
+                f"shap_values_summary_{vars_dv}.csv",
+                f"model_RFC_{vars_dv}_2023.joblib",
+            ],
+            "params": {
+                "estimators": estimator_backends,
+                "vars_dv": vars_dv,
+                "test_size": 0.6,
+                "optimal_k": 8,
+                "year": 2023,
+                # TreeSHAP values keyed by the model and the data, so that a stage
+                # re-run by a code change does not recompute unchanged values
+                "shap_cache": os.path.join(stamp_folder, "shap"),
+            },
+        }
+    stages["proactive"] = {
+        "func": stage_proactive,
+        "deps": [f"shap_{vars_dv}" for vars_dv in pv_types],
+        "inputs": sum([stages[f"shap_{v}"]["outputs"] for v in pv_types], [])
+        + ["pv_muni_params.csv", "japanadmincode.csv", "pv_growth_outlier.csv"],
+        "outputs": ["proactive_outliers.csv"],
+        "params": {
+            "estimators": estimator_backends,
+            "year": 2023,
+            "inc_ratio_min": {"PV_R": 1.3, "PV_S": 1.5},
+        },
+    }
+    for stage in stages.values():
+        stage["inputs"] = [os.path.join(folder, fn) for fn in stage["inputs"]]
+        stage["outputs"] = [os.path.join(folder, fn) for fn in stage["outputs"]]
+    return stages
+
+
+def pipeline_artifacts(folder="data"):
+    """
+    every file written by the pipeline, including its stamp folder.
+    """
+    outputs = [fn for stage in get_stages(folder).values() for fn in stage["outputs"]]
+    return outputs + [os.path.join(folder, stamp_folder)]
+
+
+# ============================================================================ #
+# Runner
+# ============================================================================ #
+def stage_fingerprint(name, stage):
+    h = hashlib.sha256()
+    h.update(name.encode())
+    h.update(json.dumps(stage["params"], sort_keys=True).encode())
+    for fn in stage["inputs"]:
+        h.update(os.path.basename(fn).encode())
+        h.update(file_hash(fn).encode())
+    h.update(file_hash(*utils_files).encode())
+    return h.hexdigest()
+
+
+def _stamp_fn(folder, name):
+    return os.path.join(folder, stamp_folder, f"{name}.json")
+
+
+def is_stale(folder, name, stage):
+    """
+    True if the stage has to run: no stamp, a different fingerprint, or an output
+    that is missing or differs from what the stage wrote.
+    """
+    stamp_fn = _stamp_fn(folder, name)
+    if not os.path.exists(stamp_fn):
+        return True
+    with open(stamp_fn) as f:
+        stamp = json.load(f)
+    if stamp.get("fingerprint") != stage_fingerprint(name, stage):
+        return True
+    for fn in stage["outputs"]:
+        if not os.path.exists(fn) or stamp["outputs"].get(fn) != file_hash(fn):
+            return True
+    return False
+
+
+def _write_stamp(folder, name, stage, fingerprint, elapsed):
+    os.makedirs(os.path.join(folder, stamp_folder), exist_ok=True)
+    stamp = {
+        "fingerprint": fingerprint,
+        "outputs": {fn: file_hash(fn) for fn in stage["outputs"]},
+        "elapsed": elapsed,
+    }
+    with open(_stamp_fn(folder, name), "w") as f:
+        json.dump(stamp, f, indent=2)
+
+
+def _run_stage(name, folder, n_jobs):
+    stage = get_stages(folder)[name]
+    fingerprint = stage_fingerprint(name, stage)
+    start = time.perf_counter()
+    stage["func"](folder, stage["params"], n_jobs=n_jobs)
+    elapsed = time.perf_counter() - start
+    _write_stamp(folder, name, stage, fingerprint, elapsed)
+    return elapsed
+
+
+def _with_deps(stages, targets):
+    selected = set()
+    pending = list(targets)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending.extend(stages[name]["deps"])
+    return selected
+
+
+def run_pipeline(
+    folder="data", targets=None, force=False, max_workers=2, dry_run=False
+):
+    """
+    runs the stale stages needed for `targets` (all stages by default). A stage starts
+    once its dependencies are done; its staleness is checked at that point so that an
+    upstream re-run that reproduces the same files does not trigger it.
+    Returns a dict of stage -> "fresh", "run" or "stale" (dry run).
+    """
+    stages = get_stages(folder)
+    selected = _with_deps(stages, targets or list(stages))
+    n_jobs = max(1, (os.cpu_count() or 1) // max_workers)
+
+    order = [name for name in stages if name in selected]
+    status = dict()
+    running = dict()
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        while len(status) < len(selected):
+            progress = True
+            while progress:
+                progress = False
+                for name in order:
+                    deps_done = all(
+                        status.get(dep) in ("fresh", "run")
+                        for dep in stages[name]["deps"]
+                    )
+                    if name in status or name in running.values() or not deps_done:
+                        continue
+                    progress = True
+                    if not (force or is_stale(folder, name, stages[name])):
+                        status[name] = "fresh"
+                        print(f"[fresh] {name}")
+                    elif dry_run:
+                        status[name] = "stale"
+                        print(f"[stale] {name}")
+                    else:
+                        print(f"[run]   {name}")
+                        running[pool.submit(_run_stage, name, folder, n_jobs)] = name
+
+            if not running:
+                # only reached on a dry run: everything downstream of a stale stage
+                for name in order:
+                    if name not in status:
+                        status[name] = "stale"
+                        print(f"[stale] {name}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                elapsed = future.result()
+                status[name] = "run"
+                print(f"[done]  {name} ({elapsed:.1f} s)")
+
+    return status
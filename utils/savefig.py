@@ -1,7 +1,10 @@
 import matplotlib.pyplot as plt
 import os
 
+from utils.nbutils_profile import profiled
 
+
+@profiled
 def savefig_template(save_flag, base_folder, fig, fn, dpi=100, **kwargs):
     if save_flag:
         fig.savefig(